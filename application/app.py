@@ -1,8 +1,11 @@
 import asyncio
 
+from application.core.amqp_publisher import AMQPPublisher
 from application.core.app import BaseApp
+from application.core.db_listener import DBListener
 from application.core.http_client import HttpClient
 from application.core.http_server import HttpServer
+from application.core.loop_monitor import LoopMonitor
 from application.db.main_db import MainDb
 from application.handlers.main_handler import MainHandler
 
@@ -12,28 +15,55 @@ class Application(BaseApp):
         super(Application, self).__init__(config=config, loop=loop)
         self.attach_component(
             'http_cln',
-            HttpClient()
+            HttpClient(config.get('http_client'))
         )
         self.attach_component(
             'db_main',
             MainDb(config['db']),
             stop_after=['http_srv']
         )
+        if 'listen' in config['db']:
+            self.attach_component(
+                'db_listener',
+                DBListener(config['db'], [self.db_main]),
+                depends_on=['db_main']
+            )
         self.attach_component(
             'http_srv',
             HttpServer(
                 self,
                 config['system']['host'],
                 config['system']['port'],
-                MainHandler
+                MainHandler,
+                reuse_port=config['system'].get('workers', 1) > 1,
+                metrics_path=config['system'].get('metrics_path'),
+                profiler=config['system'].get('profiler')
             ),
+            depends_on=['http_cln', 'db_main']
         )
 
+        if 'loop_monitor' in config:
+            self.attach_component(
+                'loop_monitor',
+                LoopMonitor(config['loop_monitor'])
+            )
+
+        if 'tasks' in config:
+            self.attach_component(
+                'tasks_pub',
+                AMQPPublisher(config['tasks']),
+                stop_after=['http_srv']
+            )
+
         if 'logging' in config:
             self.setup_logging(
                 tracer_driver=config['logging']['tracer'],
                 tracer_svc_name=config['logging']['tracer_svc_name'],
                 tracer_url=config['logging']['tracer_url'],
                 statsd_addr=config['logging']['statsd_addr'],
-                statsd_prefix=config['logging']['statsd_prefix']
+                statsd_prefix=config['logging']['statsd_prefix'],
+                body_capture=config['logging'].get('body_capture'),
+                statsd_aggregate=config['logging'].get('statsd_aggregate'),
+                span_queue=config['logging'].get('span_queue'),
+                sampler=config['logging'].get('sampler')
             )
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+from collections import deque
+
+import aioamqp
+
+from application.core.component import Component
+from application.core.helper import Error
+
+
+class PublisherError(Error):
+    pass
+
+
+class AMQPPublisher(Component):
+
+    CONNECTION_DELAY = 1
+    MAX_CONNECTION_DELAY = 30
+
+    def __init__(self, config):
+        super().__init__()
+        self.config = {
+            'host': config.get('host', 'localhost'),
+            'port': config.get('port', ),
+            'virtualhost': config.get('virtualhost', '/'),
+            'login': config.get('login', 'guest'),
+            'password': config.get('password', 'guest'),
+        }
+        self.exchange_name = config.get('exchange_name', '')
+        self.routing_key = config.get('routing_key', '')
+        self.channels_count = max(1, config.get('channels', 4))
+        self.confirms = config.get('confirms', False)
+        self.batch_size = config.get('batch_size', 100)
+        self.flush_interval = config.get('flush_interval', 0.005)
+        self.max_pending = config.get('max_pending', 10000)
+        self.stop_timeout = config.get('stop_timeout', 5)
+        self.transport = None
+        self.protocol = None
+        self._channels: list = []
+        self._queue: asyncio.Queue = None
+        # messages taken from the queue but not sent yet
+        self._retry: deque = deque()
+        self._sending: list = []
+        self._connected: asyncio.Event = None
+        self._connecting = None
+        self._flusher = None
+        self._closing = False
+
+    async def prepare(self):
+        self.app.log_info("Preparing AMQP publisher...")
+        self._queue = asyncio.Queue(maxsize=self.max_pending, loop=self.loop)
+        self._connected = asyncio.Event(loop=self.loop)
+
+    async def start(self):
+        self._reconnect()
+        self._flusher = asyncio.ensure_future(self._flush_loop(), loop=self.loop)
+
+    async def stop(self):
+        self._closing = True
+        if self._flusher:
+            try:
+                await asyncio.wait_for(self._drained(), self.stop_timeout, loop=self.loop)
+            except asyncio.TimeoutError:
+                self.app.log_warn("AMQP publisher stopped with %s unsent messages" % self._unsent())
+            self._flusher.cancel()
+            self._fail_unsent()
+        if self._connecting:
+            self._connecting.cancel()
+        await self.disconnect()
+        self.app.log_info("Stop AMQP publisher.")
+
+    async def publish(self, payload, exchange_name=None, routing_key=None, properties=None, wait=False):
+        """
+        Enqueue message for publishing. With wait=True returns after the message
+        was written to the broker (and confirmed if publisher confirms are on).
+        Raises PublisherError when max_pending messages are already buffered.
+        """
+        fut = self.loop.create_future() if wait else None
+        try:
+            self._queue.put_nowait((
+                payload,
+                self.exchange_name if exchange_name is None else exchange_name,
+                self.routing_key if routing_key is None else routing_key,
+                properties,
+                fut
+            ))
+        except asyncio.QueueFull:
+            raise PublisherError('AMQP publisher buffer is full (%s messages)' % self.max_pending)
+        if fut is not None:
+            await fut
+
+    def _unsent(self):
+        return self._queue.qsize() + len(self._retry) + len(self._sending)
+
+    async def _drained(self):
+        while self._unsent():
+            await asyncio.sleep(self.flush_interval or 0.01, loop=self.loop)
+
+    def _fail_unsent(self):
+        items = list(self._sending) + list(self._retry)
+        while not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        self._sending = []
+        self._retry.clear()
+        for item in items:
+            fut = item[4]
+            if fut is not None and not fut.done():
+                fut.set_exception(PublisherError('AMQP publisher stopped before the message was sent'))
+
+    def _reconnect(self):
+        self._connected.clear()
+        if not self._closing and (self._connecting is None or self._connecting.done()):
+            self._connecting = asyncio.ensure_future(self._connect_loop(), loop=self.loop)
+
+    async def _connect_loop(self):
+        to_wait = self.CONNECTION_DELAY
+        while not self._closing:
+            try:
+                await self.connect()
+            except (OSError, aioamqp.AioamqpException) as e:
+                logging.info("[x] Failed to connect to AMQP publisher broker: %s. Waiting %s seconds...", e, to_wait)
+                await asyncio.sleep(to_wait, loop=self.loop)
+                to_wait = min(self.MAX_CONNECTION_DELAY, to_wait * 2)
+            else:
+                self._connected.set()
+                self.app.log_info("AMQP publisher connected.")
+                return
+
+    async def connect(self):
+        await self.disconnect()
+        self.transport, self.protocol = await aioamqp.connect(
+            **self.config,
+            loop=self.loop,
+            on_error=self.error_callback
+        )
+        channels = []
+        for i in range(self.channels_count):
+            channel = await self.protocol.channel()
+            if self.confirms:
+                await channel.confirm_select()
+            channels.append(channel)
+        self._channels = channels
+
+    async def disconnect(self):
+        self._channels = []
+        if self.transport and self.protocol:
+            transport, protocol = self.transport, self.protocol
+            self.transport = self.protocol = None
+            try:
+                await protocol.close()
+            except Exception:
+                pass
+            transport.close()
+
+    async def error_callback(self, error):
+        if not self._closing:
+            self.app.log_warn("AMQP publisher connection error: %s" % error)
+            self._reconnect()
+
+    async def _flush_loop(self):
+        while True:
+            batch = await self._next_batch()
+            if not self._connected.is_set():
+                self._retry.extendleft(reversed(batch))
+                await self._connected.wait()
+                continue
+            # kept on cancel, stop() fails their futures
+            self._sending = batch
+            failed = await self._send_batch(batch)
+            self._sending = []
+            if failed:
+                self._retry.extendleft(reversed(failed))
+                self._reconnect()
+
+    async def _next_batch(self):
+        batch = []
+        while self._retry and len(batch) < self.batch_size:
+            batch.append(self._retry.popleft())
+        if not batch:
+            batch.append(await self._queue.get())
+            if self.flush_interval and self._queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.flush_interval, loop=self.loop)
+        while len(batch) < self.batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _send_batch(self, batch):
+        channels = [ch for ch in self._channels if ch.is_open]
+        if not channels:
+            return batch
+        chunks = [batch[i::len(channels)] for i in range(len(channels))]
+        results = await asyncio.gather(
+            *[self._send_chunk(channel, chunk) for channel, chunk in zip(channels, chunks)],
+            loop=self.loop
+        )
+        failed = []
+        for chunk_failed in results:
+            failed.extend(chunk_failed)
+        return failed
+
+    async def _send_chunk(self, channel, chunk):
+        # frames of a single publish are written without yielding, so messages
+        # can be pipelined on one channel and confirms awaited together
+        results = await asyncio.gather(
+            *[channel.publish(payload, exchange_name, routing_key, properties=properties)
+              for payload, exchange_name, routing_key, properties, fut in chunk],
+            loop=self.loop,
+            return_exceptions=True
+        )
+        failed = []
+        for item, res in zip(chunk, results):
+            fut = item[4]
+            if isinstance(res, aioamqp.PublishFailed):
+                logging.error('AMQP publish to %s/%s was nacked', item[1], item[2])
+                if fut is not None and not fut.done():
+                    fut.set_exception(res)
+            elif isinstance(res, Exception):
+                failed.append(item)
+            elif fut is not None and not fut.done():
+                fut.set_result(None)
+        return failed
@@ -1,10 +1,264 @@
 import json
 import asyncio
+import logging
+
 import aioamqp
 
 from application.core.component import Component
 
 
+class AckBatcher(object):
+    """
+    Acknowledges completed deliveries of one channel. Several deliveries are
+    confirmed with a single multiple=True ack, but only up to the lowest tag
+    that is still being processed.
+    """
+    def __init__(self, channel, batch_size, interval, loop):
+        self.channel = channel
+        self.batch_size = batch_size
+        self.interval = interval
+        self.loop = loop
+        self._in_flight: set = set()
+        self._done: list = []
+        self._timer = None
+
+    def received(self, delivery_tag):
+        self._in_flight.add(delivery_tag)
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    async def ack(self, delivery_tags):
+        for tag in delivery_tags:
+            self._in_flight.discard(tag)
+        if self.batch_size <= 1 and len(delivery_tags) == 1:
+            await self.channel.basic_client_ack(delivery_tags[0])
+            return
+        self._done.extend(delivery_tags)
+        if len(self._done) >= self.batch_size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(
+                self.interval, lambda: asyncio.ensure_future(self.flush(), loop=self.loop))
+
+    async def nack(self, delivery_tags, requeue=True):
+        for tag in delivery_tags:
+            self._in_flight.discard(tag)
+            await self.channel.basic_client_nack(tag, requeue=requeue)
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._done:
+            return
+        if self._in_flight:
+            limit = min(self._in_flight)
+            ackable = [tag for tag in self._done if tag < limit]
+            self._done = [tag for tag in self._done if tag > limit]
+        else:
+            ackable = self._done
+            self._done = []
+        if ackable:
+            await self.channel.basic_client_ack(max(ackable), multiple=True)
+        if self._done and self._timer is None:
+            self._timer = self.loop.call_later(
+                self.interval, lambda: asyncio.ensure_future(self.flush(), loop=self.loop))
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class Consumer(object):
+    """
+    Pool of workers processing messages of one queue with manual acks.
+
+    With 'batch_size' option the handler is called as func(channel, messages)
+    where messages is a list of (body, envelope, properties) collected until
+    the batch is full or 'batch_timeout' seconds passed.
+    """
+    def __init__(self, server, name, queue_name, func, options):
+        self.server = server
+        self.name = name
+        self.queue_name = queue_name
+        self.func = func
+        self.workers = options.get('workers', server.workers) or 1
+        self.batch_size = options.get('batch_size', 0)
+        self.batch_timeout = options.get('batch_timeout', 1.0)
+        self.prefetch_count = (
+            options.get('prefetch_count', server.prefetch_count) or
+            self.workers * max(self.batch_size, 1)
+        )
+        self.ack_batch = options.get('ack_batch', server.ack_batch)
+        self.requeue = options.get('requeue', server.requeue)
+        self.channel = None
+        self.acker: AckBatcher = None
+        self.consumer_tag = None
+        self._buffer: asyncio.Queue = None
+        self._tasks: list = []
+        self._duration = server.message_duration.labels(queue_name)
+        self._acked = server.messages.labels(queue_name, 'ack')
+        self._nacked = server.messages.labels(queue_name, 'nack')
+
+    @property
+    def loop(self):
+        return self.server.loop
+
+    async def start(self, protocol):
+        self.channel = await protocol.channel()
+        await self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.acker = AckBatcher(self.channel, self.ack_batch, self.server.ack_interval, self.loop)
+        self._buffer = asyncio.Queue(loop=self.loop)
+        self._tasks = [
+            asyncio.ensure_future(self._worker(), loop=self.loop)
+            for _ in range(self.workers)
+        ]
+        res = await self.channel.basic_consume(
+            self.on_message,
+            queue_name=self.queue_name,
+            no_ack=False
+        )
+        self.consumer_tag = res['consumer_tag']
+
+    async def stop(self, drain=True):
+        """
+        :param drain: finish buffered messages first, only possible while the
+            channel is open, otherwise their acks would fail and the broker
+            redelivers them anyway
+        """
+        drain = drain and self.channel is not None and self.channel.is_open
+        if drain and self.consumer_tag:
+            try:
+                await self.channel.basic_cancel(self.consumer_tag)
+            except aioamqp.AioamqpException:
+                pass
+        if drain and self._buffer is not None and self._tasks:
+            try:
+                await asyncio.wait_for(self._buffer.join(), self.server.stop_timeout, loop=self.loop)
+            except asyncio.TimeoutError:
+                pass
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._buffer is not None:
+            while not self._buffer.empty():
+                self._buffer.get_nowait()
+                self._buffer.task_done()
+        if self.acker:
+            try:
+                if self.channel.is_open:
+                    await self.acker.flush()
+            except aioamqp.AioamqpException as e:
+                logging.error('AMQP consumer %s final ack failed: %s', self.name, e)
+            self.acker.close()
+
+    @property
+    def buffered(self):
+        return self._buffer.qsize() if self._buffer is not None else 0
+
+    @property
+    def in_flight(self):
+        return self.acker.in_flight if self.acker else 0
+
+    async def on_message(self, channel, body, envelope, properties):
+        self.acker.received(envelope.delivery_tag)
+        self._buffer.put_nowait((channel, body, envelope, properties))
+
+    async def _worker(self):
+        getter = None
+        try:
+            while True:
+                if self.batch_size:
+                    messages, getter = await self._collect(getter)
+                    try:
+                        await self._process_batch(messages)
+                    finally:
+                        for _ in messages:
+                            self._buffer.task_done()
+                else:
+                    message = await self._buffer.get()
+                    try:
+                        await self._process(message)
+                    finally:
+                        self._buffer.task_done()
+        finally:
+            if getter is not None:
+                getter.cancel()
+
+    async def _collect(self, getter):
+        """
+        :param getter: buffer get() still pending after the previous batch timed out
+        :return: messages and the pending getter, if any
+        """
+        # the getter is kept instead of cancelled on timeout, wait_for could lose
+        # a message taken from the buffer at the same moment
+        if getter is None:
+            getter = asyncio.ensure_future(self._buffer.get(), loop=self.loop)
+        messages = [await getter]
+        getter = None
+        deadline = self.loop.time() + self.batch_timeout
+        while len(messages) < self.batch_size:
+            if not self._buffer.empty():
+                messages.append(self._buffer.get_nowait())
+                continue
+            timeout = deadline - self.loop.time()
+            if timeout <= 0:
+                break
+            getter = asyncio.ensure_future(self._buffer.get(), loop=self.loop)
+            done, _ = await asyncio.wait([getter], timeout=timeout, loop=self.loop)
+            if not done:
+                break
+            messages.append(getter.result())
+            getter = None
+        return messages, getter
+
+    async def _process_batch(self, messages):
+        channel = messages[0][0]
+        tags = [envelope.delivery_tag for _, _, envelope, _ in messages]
+        started = self.loop.time()
+        try:
+            await self.func(channel, [(body, envelope, properties) for _, body, envelope, properties in messages])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.server.app.log_err(e)
+            self._nacked.inc(len(tags))
+            await self._settle(self.acker.nack, tags, self.requeue)
+        else:
+            self._acked.inc(len(tags))
+            await self._settle(self.acker.ack, tags)
+            await self._settle(self.acker.flush)
+        finally:
+            self._duration.observe(self.loop.time() - started)
+
+    async def _process(self, message):
+        channel, body, envelope, properties = message
+        started = self.loop.time()
+        try:
+            await self.func(channel, body, envelope, properties)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.server.app.log_err(e)
+            self._nacked.inc()
+            await self._settle(self.acker.nack, [envelope.delivery_tag], self.requeue)
+        else:
+            self._acked.inc()
+            await self._settle(self.acker.ack, [envelope.delivery_tag])
+        finally:
+            self._duration.observe(self.loop.time() - started)
+
+    async def _settle(self, method, *args):
+        try:
+            await method(*args)
+        except aioamqp.AioamqpException as e:
+            # channel is gone, broker will redeliver unacked messages
+            logging.error('AMQP consumer %s ack failed: %s', self.name, e)
+
+
 class AMQPServer(Component):
 
     CONNECTION_DELAY = 1
@@ -22,25 +276,50 @@ class AMQPServer(Component):
         self.exchange_name = config.get('exchange_name', 'mocker')
         self.exchange_type = config.get('exchange_type', 'topic')
         self.exchange_durable = config.get('exchange_durable', True)
+        # consumer mode: routes get a worker pool with manual acks
+        self.workers = config.get('workers', 0)
+        self.prefetch_count = config.get('prefetch_count', 0)
+        self.ack_batch = config.get('ack_batch', 1)
+        self.ack_interval = config.get('ack_interval', 0.1)
+        self.requeue = config.get('requeue', True)
+        self.stop_timeout = config.get('stop_timeout', 10)
+        self.stats_interval = config.get('stats_interval', 10)
         self.transport = None
         self.protocol = None
         self.channel = None
         self.consumers = handlers
         self.consumers_list = []
         self.started = []
+        self._stats_task = None
+        self.message_duration = None
+        self.messages = None
 
     async def prepare(self):
         self.app.log_info("Preparing to start AMQP server...")
+        self.message_duration = self.app.metrics.histogram(
+            'amqp_message_duration_seconds',
+            'Time spent handling consumed messages or batches',
+            ('queue',)
+        )
+        self.messages = self.app.metrics.counter(
+            'amqp_messages_total',
+            'Consumed messages by result',
+            ('queue', 'result')
+        )
         self.consumers_list = self.consumers.routes()
 
     async def start(self):
+        # channels of a lost connection are dead, nothing to drain
+        await self._stop_consumers(drain=False)
         await self.connect()
         await self.channel.exchange_declare(
             exchange_name=self.exchange_name,
             type_name=self.exchange_type,
             durable=self.exchange_durable,
         )
-        for name, queue_name, func in self.consumers_list:
+        for route in self.consumers_list:
+            name, queue_name, func = route[:3]
+            options = route[3] if len(route) > 3 else {}
             # TODO: wait for
             await self.channel.queue_declare(
                 queue_name=queue_name,
@@ -51,19 +330,47 @@ class AMQPServer(Component):
                 queue_name=queue_name,
                 routing_key=queue_name
             )
-            await self.channel.basic_consume(       # TODO: get tag
-                func,
-                queue_name=queue_name,
-                no_ack=True
-            )
+            if options.get('workers', self.workers) or options.get('batch_size'):
+                consumer = Consumer(self, name, queue_name, func, options)
+                await consumer.start(self.protocol)
+                self.started.append(consumer)
+            else:
+                await self.channel.basic_consume(       # TODO: get tag
+                    func,
+                    queue_name=queue_name,
+                    no_ack=True
+                )
             self.app.log_info("Start consumer '%s'." % name)
+        if self.started and self.stats_interval and self._stats_task is None:
+            self._stats_task = asyncio.ensure_future(self._stats_loop(), loop=self.loop)
 
     async def stop(self):
+        if self._stats_task:
+            self._stats_task.cancel()
+            self._stats_task = None
+        await self._stop_consumers()
         # TODO: сделать через basic_cancel и тег
         # await self.channel.stop_consuming()
         await self.disconnect()
         self.app.log_info("Stop AMQP server.")
 
+    async def _stop_consumers(self, drain=True):
+        started, self.started = self.started, []
+        await asyncio.gather(*[consumer.stop(drain) for consumer in started], loop=self.loop)
+
+    async def _stats_loop(self):
+        while True:
+            await asyncio.sleep(self.stats_interval, loop=self.loop)
+            for consumer in self.started:
+                tags = [('queue', consumer.queue_name)]
+                try:
+                    res = await self.channel.queue_declare(queue_name=consumer.queue_name, passive=True)
+                except aioamqp.AioamqpException:
+                    continue
+                self.app.stats_gauge('amqp_queue_depth', res['message_count'], tags)
+                self.app.stats_gauge('amqp_buffered', consumer.buffered, tags)
+                self.app.stats_gauge('amqp_in_flight', consumer.in_flight, tags)
+
     async def connect(self):
         try:
             loop = asyncio.get_event_loop()
@@ -1,12 +1,16 @@
 import asyncio
+import os
 import signal
 import logging
+import time
 
 import aiozipkin as az
 from aiohttp.web_runner import _raise_graceful_exit
 
 from application.core.component import Component
-from application.core.helper import GracefulExit, PrepareError
+from application.core.helper import BodyCapture, GracefulExit, PrepareError
+from application.core.metrics import MetricsRegistry
+from application.core.sampler import AdaptiveSampler
 from application.core.tracer import TracerTransport
 
 
@@ -17,15 +21,26 @@ class BaseApp(object):
         self.loop = loop or asyncio.get_event_loop()
         self._components: dict = {}
         self._stop_deps: dict = {}
-        self._stopped: list = []
+        self._deps: dict = {}
         self._tracer: az.Tracer = None
+        self._tracer_transport: TracerTransport = None
+        self._sampler: AdaptiveSampler = None
+        self.worker_id = None
+        self.body_capture = BodyCapture()
+        self.metrics = MetricsRegistry()
 
     def attach_component(
             self,
             name: str,
             comp: Component,
-            stop_after: list = None
+            stop_after: list = None,
+            depends_on: list = None
     ):
+        """
+        :param stop_after: components which have to be stopped before this one
+        :param depends_on: components which have to be prepared and started
+            before this one and stopped after it
+        """
         if not isinstance(comp, Component):
             raise UserWarning()
         if name in self._components:
@@ -34,6 +49,7 @@ class BaseApp(object):
         comp.app = self
         self._components[name] = comp
         self._stop_deps[name] = stop_after
+        self._deps[name] = depends_on
 
     def __getattr__(self, item):
         if item not in self._components:
@@ -59,6 +75,21 @@ class BaseApp(object):
     def log_debug(debug):
         logging.debug(debug)
 
+    def stats_gauge(self, name, value, tags=None):
+        if self._tracer_transport:
+            self._tracer_transport.send_gauge(name, value, tags)
+
+    def stats_counter(self, name, value=1, tags=None):
+        if self._tracer_transport:
+            self._tracer_transport.send_counter(name, value, tags)
+
+    def stats_timer(self, name, value, tags=None):
+        """
+        :param value: milliseconds
+        """
+        if self._tracer_transport:
+            self._tracer_transport.send_timer(name, value, tags)
+
     def setup_logging(
             self,
             tracer_driver,
@@ -67,10 +98,21 @@ class BaseApp(object):
             statsd_addr,
             statsd_prefix,
             sample_rate=1.0,
-            send_inteval=3
+            send_inteval=3,
+            body_capture=None,
+            statsd_aggregate=None,
+            span_queue=None,
+            sampler=None
     ):
+        """
+        :param body_capture: {'enabled': True, 'max_bytes': 4096, 'content_types': ['text/', ...]}
+        :param statsd_aggregate: {'max_samples': 100, 'summary': False, 'packet_size': 1432}
+        :param span_queue: {'max_size': 10000, 'batch_size': 1000, 'drop': 'oldest', 'timeout': 5}
+        :param sampler: AdaptiveSampler config, sample_rate is used when it has no own rate
+        """
+        self.body_capture = BodyCapture.from_config(body_capture)
         endpoint = az.create_endpoint(tracer_svc_name)
-        sampler = az.Sampler(sample_rate=sample_rate)
+        sampler = AdaptiveSampler.from_config(sampler, sample_rate)
 
         transport = TracerTransport(
             tracer_driver,
@@ -78,10 +120,14 @@ class BaseApp(object):
             statsd_addr,
             statsd_prefix,
             send_inteval=send_inteval,
-            loop=self.loop
+            loop=self.loop,
+            statsd_aggregate=statsd_aggregate,
+            span_queue=span_queue
         )
 
         self._tracer = az.Tracer(transport, sampler, endpoint)
+        self._tracer_transport = transport
+        self._sampler = sampler
 
     async def _shutdown_tracer(self):
         if self._tracer:
@@ -92,7 +138,81 @@ class BaseApp(object):
     def tracer(self):
         return self._tracer
 
+    @property
+    def sampler(self):
+        return self._sampler
+
     def run(self):
+        system = (self.config or {}).get('system', {})
+        workers = system.get('workers', 1)
+        if workers > 1:
+            return self._run_supervisor(workers, system.get('worker_restart_delay', 1))
+        return self._run_single()
+
+    def _run_supervisor(self, workers, restart_delay):
+        """
+        Forks workers, each building its own app with own loop and components.
+        Crashed workers are restarted, SIGINT/SIGTERM are forwarded to them.
+        """
+        children = {}
+        started = {}
+        stopping = False
+
+        def spawn(worker_id):
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    signal.signal(signal.SIGINT, signal.SIG_DFL)
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    loop = asyncio.new_event_loop()
+                    asyncio.set_event_loop(loop)
+                    app = type(self)(config=self.config, loop=loop)
+                    app.worker_id = worker_id
+                    code = app._run_single()
+                except BaseException as e:
+                    self.log_err(e)
+                finally:
+                    os._exit(code)
+            children[pid] = worker_id
+            started[worker_id] = time.monotonic()
+            self.log_info('Started worker %s (pid %s)' % (worker_id, pid))
+
+        def on_signal(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for pid in list(children):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        signal.signal(signal.SIGINT, on_signal)
+        signal.signal(signal.SIGTERM, on_signal)
+
+        for worker_id in range(workers):
+            spawn(worker_id)
+
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker_id = children.pop(pid, None)
+            if worker_id is None or stopping:
+                continue
+            self.log_warn('Worker %s (pid %s) exited with status %s, restarting' % (worker_id, pid, status))
+            if time.monotonic() - started[worker_id] < restart_delay:
+                time.sleep(restart_delay)
+            if not stopping:
+                spawn(worker_id)
+
+        self.loop.run_until_complete(self._shutdown_tracer())
+        self.loop.close()
+        print("Bye")
+        return 0
+
+    def _run_single(self):
         try:
             self.loop.run_until_complete(self.run_prepare())
         except PrepareError as e:
@@ -109,11 +229,18 @@ class BaseApp(object):
         return 0
 
     async def run_prepare(self):
+        loop_cls = type(self.loop)
+        self.log_info('Event loop: %s.%s' % (loop_cls.__module__, loop_cls.__name__))
+        waves = self._waves(self._deps)
+        self._waves(self._stop_graph())
+
         self.log_info('Prepare for start')
-        await asyncio.gather(*[comp.prepare() for comp in self._components.values()], loop=self.loop)
+        for wave in waves:
+            await asyncio.gather(*[self._run_comp(name, 'prepare') for name in wave], loop=self.loop)
 
         self.log_info('Starting...')
-        await asyncio.gather(*[comp.start() for comp in self._components.values()], loop=self.loop)
+        for wave in waves:
+            await asyncio.gather(*[self._run_comp(name, 'start') for name in wave], loop=self.loop)
         self.log_info('Running...')
 
     def run_loop(self):
@@ -130,15 +257,50 @@ class BaseApp(object):
 
     async def run_shutdown(self):
         self.log_info('Shutting down...')
-        for comp_name in self._components:
-            await self._stop_comp(comp_name)
+        for wave in self._waves(self._stop_graph()):
+            results = await asyncio.gather(
+                *[self._run_comp(name, 'stop') for name in wave],
+                loop=self.loop,
+                return_exceptions=True
+            )
+            for res in results:
+                if isinstance(res, Exception):
+                    self.log_err(res)
         await self._shutdown_tracer()
 
-    async def _stop_comp(self, name):
-        if name in self._stopped:
-            return
-        if name in self._stop_deps and self._stop_deps[name]:
-            for dep_name in self._stop_deps[name]:
-                await self._stop_comp(dep_name)
-        await self._components[name].stop()
-        self._stopped.append(name)
+    def _stop_graph(self):
+        # dependent components stop before their dependencies
+        stop_deps = {}
+        for name in self._components:
+            stop_deps[name] = set(self._stop_deps.get(name) or [])
+            stop_deps[name].update(
+                dependent for dependent, deps in self._deps.items() if deps and name in deps)
+        return stop_deps
+
+    async def _run_comp(self, name, action):
+        started = time.monotonic()
+        await getattr(self._components[name], action)()
+        self.log_info('Component %s %s took %.3fs' % (name, action, time.monotonic() - started))
+
+    def _waves(self, deps):
+        """
+        Splits components into groups, each depends only on previous groups.
+        """
+        remaining = {}
+        for name in self._components:
+            names = set(deps.get(name) or [])
+            unknown = names - set(self._components)
+            if unknown:
+                raise PrepareError('Component %s depends on unknown %s' % (name, ', '.join(sorted(unknown))))
+            remaining[name] = names
+        waves = []
+        while remaining:
+            wave = [name for name, names in remaining.items() if not names]
+            if not wave:
+                raise PrepareError('Cyclic component dependencies: %s' % ', '.join(sorted(remaining)))
+            waves.append(wave)
+            for name in wave:
+                del remaining[name]
+            for names in remaining.values():
+                names.difference_update(wave)
+        return waves
@@ -0,0 +1,47 @@
+import time
+from collections import OrderedDict
+
+
+class QueryCache(object):
+    """
+    Size bounded LRU cache with per item TTL.
+    Keys are (db_id, args) tuples, so invalidation works by db_id prefix too.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, kind=None):
+        item = self._data.get(key)
+        if item is not None:
+            expires, item_kind, value = item
+            if expires > time.monotonic() and item_kind == kind:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self._data[key]
+        self.misses += 1
+        return False, None
+
+    def set(self, key, value, ttl, kind=None):
+        self._data[key] = (time.monotonic() + ttl, kind, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, db_id, *args):
+        self._data.pop((db_id, args), None)
+
+    def invalidate_prefix(self, prefix):
+        keys = [key for key in self._data if key[0].startswith(prefix)]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
@@ -1,44 +1,193 @@
 import logging
+from functools import wraps
 import aiozipkin as az
 import asyncio
 import asyncpg
 
 from application.core.app import Component
-from application.core.helper import PrepareError
+from application.core.cache import QueryCache
+from application.core.helper import PrepareError, is_sampled
+from application.core.singleflight import SingleFlight
 
 
-def db_decorator(func):
+def make_dsn(config):
+    return 'postgres://%s:%s@%s:5432/%s' % (
+        config['username'],
+        config['password'],
+        config['host'],
+        config['dbname']
+    )
+
+
+def _start_span(parent, name):
+    if not is_sampled(parent):
+        return None
+    span = parent.tracer.new_child(parent.context)
+    span.kind(az.CLIENT)
+    span.name(name)
+    span.remote_endpoint("postgres")
+    span.start()
+    return span
+
+
+def _finish_span(span, rows=None, error=None):
+    if span:
+        if rows is not None:
+            span.tag('db.rows', str(rows))
+        if error is not None:
+            span.tag('error', 'true')
+            span.tag('error.message', str(error))
+        span.finish()
+
+
+def _rows(res):
+    if isinstance(res, list):
+        return len(res)
+    if isinstance(res, asyncpg.Record):
+        return 1
+    if res is None:
+        return 0
+    return None
+
+
+def db_decorator(func, args_offset=4):
+    @wraps(func)
     async def wrapper(*args, **kwargs):
-        context_span, db_id, res = await func(*args, **kwargs)
-        with context_span.tracer.new_child(context_span.context) as span:
-            i = 0
-            a_args = []
-            for arg in args:
-                if i > 3:
-                    a_args.append(arg)
-                i = i + 1
-
-            span.kind(az.CLIENT)
-            span.name("db:%s" % db_id)
-            span.remote_endpoint("postgres")
-            span.annotate(repr(a_args))
-        return res
+        db, context_span, db_id = args[0], args[1], args[2]
+        started = db.loop.time()
+        try:
+            span = _start_span(context_span, "db:%s" % db_id)
+            if span is None:
+                _, _, res = await func(*args, **kwargs)
+                return res
+            span.annotate(repr(list(args[args_offset:])))
+            try:
+                # the query runs under the db span, acquire and query are its children
+                _, _, res = await func(db, span, *args[2:], **kwargs)
+            except Exception as e:
+                _finish_span(span, error=e)
+                raise
+            _finish_span(span, _rows(res), res if isinstance(res, Exception) else None)
+            return res
+        finally:
+            db.query_duration.labels(db.__class__.__name__, db_id).observe(db.loop.time() - started)
     return wrapper
 
 
+def named_db_decorator(func):
+    return db_decorator(func, args_offset=3)
+
+
+def db_cache_decorator(func, params_offset=1):
+    @wraps(func)
+    async def wrapper(self, context_span, db_id, *args):
+        ttl = self.cache_ttl(db_id)
+        if not ttl:
+            return await func(self, context_span, db_id, *args)
+        key = (db_id, args[params_offset:])
+        try:
+            found, res = self.cache.get(key, func.__name__)
+        except TypeError:
+            # unhashable query arguments are never cached
+            return await func(self, context_span, db_id, *args)
+        self.app.stats_counter('db_cache', tags=[('kind', db_id), ('result', 'hit' if found else 'miss')])
+        if found:
+            return context_span, db_id, res
+        context_span, db_id, res = await func(self, context_span, db_id, *args)
+        if res is not None:
+            self.cache.set(key, res, ttl, func.__name__)
+        return context_span, db_id, res
+    return wrapper
+
+
+def named_db_cache_decorator(func):
+    return db_cache_decorator(func, params_offset=0)
+
+
+def db_coalesce_decorator(func):
+    @wraps(func)
+    async def wrapper(self, context_span, db_id, *args):
+        if self.flights is None:
+            return await func(self, context_span, db_id, *args)
+        key = (func.__name__, db_id, args)
+        try:
+            hash(key)
+        except TypeError:
+            return await func(self, context_span, db_id, *args)
+        _, _, res = await self.flights.do(key, func, self, context_span, db_id, *args)
+        # shared result must be traced under the span of this caller
+        return context_span, db_id, res
+    return wrapper
+
+
+class PreparedConnection(asyncpg.connection.Connection):
+    __slots__ = ('prepared', )
+
+
+class Transaction(object):
+    """
+    async with db.transaction(context_span) as conn:
+        await conn.execute(...)
+    """
+    def __init__(self, db, context_span):
+        self.db = db
+        self.context_span = context_span
+        self._conn = None
+        self._tr = None
+        self._span = None
+
+    async def __aenter__(self):
+        self._span = _start_span(self.context_span, "db:transaction")
+        try:
+            self._conn = await self.db._acquire(self._span, 'transaction')
+            try:
+                self._tr = self._conn.transaction()
+                await self._tr.start()
+            except Exception:
+                await self.db.pool.release(self._conn)
+                raise
+        except Exception as e:
+            _finish_span(self._span, error=e)
+            raise
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self._tr.commit()
+            else:
+                await self._tr.rollback()
+        finally:
+            await self.db.pool.release(self._conn)
+            _finish_span(self._span, error=exc)
+
+
 class DB(Component):
+    # named queries {db_id: sql}, prepared on every pooled connection
+    QUERIES: dict = {}
+    # result cache TTL in seconds {db_id: ttl}, used when config has 'cache'
+    CACHE_TTL: dict = {}
+
     def __init__(self, config):
         super(DB, self).__init__()
-        dsn = 'postgres://%s:%s@%s:5432/%s' % (
-            config['username'],
-            config['password'],
-            config['host'],
-            config['dbname']
-        )
+        dsn = make_dsn(config)
         self.connect_max_attempts = config['connect_max_attempts']
         self.connect_retry_delay = config['connect_retry_delay']
         self._dsn = dsn
         self.pool = None
+        self.cache = None
+        self.cache_ttls = dict(self.CACHE_TTL)
+        self.cache_default_ttl = 0
+        if 'cache' in config:
+            self.cache = QueryCache(config['cache'].get('max_size', 10000))
+            self.cache_ttls.update(config['cache'].get('ttl', {}))
+            self.cache_default_ttl = config['cache'].get('default_ttl', 0)
+        self.flights = SingleFlight() if config.get('coalesce') else None
+        self.stats_interval = config.get('stats_interval', 10)
+        self._stats_tags = [('db', self.__class__.__name__)]
+        self._stats_task = None
+        self.query_duration = None
+        self.query_errors = None
 
     async def _connect(self):
         while True:
@@ -50,6 +199,8 @@ class DB(Component):
                     max_queries=self.app.config['system']['pool_max_queries'],
                     max_inactive_connection_lifetime=(
                         self.app.config['system']['pool_max_inactive_connection_lifetime']),
+                    init=self._init_connection,
+                    connection_class=PreparedConnection,
                     )
             except:
                 await asyncio.sleep(5)
@@ -57,42 +208,246 @@ class DB(Component):
             else:
                 break
 
+    async def _init_connection(self, conn):
+        conn.prepared = {}
+        for db_id, sql in self.QUERIES.items():
+            try:
+                conn.prepared[db_id] = await conn.prepare(sql)
+            except Exception as e:
+                logging.error('DB prepare %s %s error: %s' % (db_id, self.__class__.__name__, str(e)))
+
+    def _named(self, conn, db_id, method, args):
+        stmt = conn.prepared.get(db_id)
+        if stmt is not None:
+            return getattr(stmt, method)(*args)
+        return getattr(conn, method)(self.QUERIES[db_id], *args)
+
+    async def _acquire(self, span, db_id):
+        acquire_span = _start_span(span, "db_acquire:%s" % db_id)
+        started = self.loop.time()
+        try:
+            conn = await self.pool.acquire()
+        except Exception as e:
+            _finish_span(acquire_span, error=e)
+            raise
+        self.app.stats_timer('db_pool_acquire', (self.loop.time() - started) * 1000, self._stats_tags)
+        _finish_span(acquire_span)
+        return conn
+
+    def pool_stats(self):
+        """
+        Snapshot of the connection pool: size, idle, in use and
+        average queries served per open connection.
+        """
+        holders = getattr(self.pool, '_holders', [])
+        conns = [h._con for h in holders if getattr(h, '_con', None) is not None]
+        in_use = sum(1 for h in holders if getattr(h, '_in_use', False))
+        queries = [c._protocol.queries_count for c in conns if hasattr(c, '_protocol')]
+        return {
+            'size': len(conns),
+            'max_size': getattr(self.pool, '_maxsize', len(holders)),
+            'in_use': in_use,
+            'idle': len(conns) - in_use,
+            'queries_per_conn': sum(queries) / len(queries) if queries else 0,
+        }
+
+    async def _stats_loop(self):
+        while True:
+            await asyncio.sleep(self.stats_interval, loop=self.loop)
+            if self.pool is None:
+                continue
+            for name, value in self.pool_stats().items():
+                self.app.stats_gauge('db_pool_%s' % name, value, self._stats_tags)
+
+    async def _run(self, span, db_id, action, transaction=False):
+        """
+        Runs action(conn) on a pooled connection, pool wait and query are
+        traced as separate children of span.
+        """
+        conn = await self._acquire(span, db_id)
+        try:
+            query_span = _start_span(span, "db_query:%s" % db_id)
+            try:
+                if transaction:
+                    async with conn.transaction():
+                        res = await action(conn)
+                else:
+                    res = await action(conn)
+            except Exception as e:
+                _finish_span(query_span, error=e)
+                self.query_errors.labels(self.__class__.__name__, db_id).inc()
+                if is_sampled(span):
+                    span.tag('error', 'true')
+                    span.tag('error.message', str(e))
+                raise
+            _finish_span(query_span, _rows(res))
+            return res
+        finally:
+            await self.pool.release(conn)
+
     @db_decorator
     async def execute(self, context_span, db_id, sql, *args):
-        async with self.pool.acquire() as conn:
-            async with conn.transaction():
-                try:
-                    await conn.execute(sql, *args)
-                except Exception as e:
-                    logging.error('DB _execute %s %s error: %s' % (sql, self.__class__.__name__, str(e)))
-                    res = e
-                else:
-                    res = None
+        try:
+            await self._run(context_span, db_id, lambda conn: conn.execute(sql, *args), transaction=True)
+        except Exception as e:
+            logging.error('DB _execute %s %s error: %s' % (sql, self.__class__.__name__, str(e)))
+            res = e
+        else:
+            res = None
         return context_span, db_id, res
 
     @db_decorator
+    @db_cache_decorator
+    @db_coalesce_decorator
     async def query(self, context_span, db_id, sql, *args):
-        async with self.pool.acquire() as conn:
-            async with conn.transaction():
-                try:
-                    res = await conn.fetchrow(sql, *args)
-                except Exception as e:
-                    logging.error('DB _query %s %s error: %s' % (sql, self.__class__.__name__, str(e)))
-                    res = None
+        try:
+            res = await self._run(context_span, db_id, lambda conn: conn.fetchrow(sql, *args))
+        except Exception as e:
+            logging.error('DB _query %s %s error: %s' % (sql, self.__class__.__name__, str(e)))
+            res = None
         return context_span, db_id, res
 
     @db_decorator
+    @db_cache_decorator
+    @db_coalesce_decorator
     async def query_all(self, context_span, db_id, sql, *args):
-        async with self.pool.acquire() as conn:
-            async with conn.transaction():
-                try:
-                    res = await conn.fetch(sql, *args)
-                except Exception as e:
-                    logging.error('DB _query_all %s %s error: %s' % (sql, self.__class__.__name__, str(e)))
-                    res = None
+        try:
+            res = await self._run(context_span, db_id, lambda conn: conn.fetch(sql, *args))
+        except Exception as e:
+            logging.error('DB _query_all %s %s error: %s' % (sql, self.__class__.__name__, str(e)))
+            res = None
+        return context_span, db_id, res
+
+    @named_db_decorator
+    async def named_execute(self, context_span, db_id, *args):
+        try:
+            await self._run(
+                context_span, db_id, lambda conn: self._named(conn, db_id, 'fetch', args), transaction=True)
+        except Exception as e:
+            logging.error('DB _named_execute %s %s error: %s' % (db_id, self.__class__.__name__, str(e)))
+            res = e
+        else:
+            res = None
+        return context_span, db_id, res
+
+    @named_db_decorator
+    @named_db_cache_decorator
+    @db_coalesce_decorator
+    async def named_query(self, context_span, db_id, *args):
+        try:
+            res = await self._run(context_span, db_id, lambda conn: self._named(conn, db_id, 'fetchrow', args))
+        except Exception as e:
+            logging.error('DB _named_query %s %s error: %s' % (db_id, self.__class__.__name__, str(e)))
+            res = None
+        return context_span, db_id, res
+
+    @named_db_decorator
+    @named_db_cache_decorator
+    @db_coalesce_decorator
+    async def named_query_all(self, context_span, db_id, *args):
+        try:
+            res = await self._run(context_span, db_id, lambda conn: self._named(conn, db_id, 'fetch', args))
+        except Exception as e:
+            logging.error('DB _named_query_all %s %s error: %s' % (db_id, self.__class__.__name__, str(e)))
+            res = None
         return context_span, db_id, res
 
+    async def execute_many(self, context_span, db_id, sql, rows):
+        span = _start_span(context_span, "db:%s" % db_id)
+        res = None
+        try:
+            await self._run(span, db_id, lambda conn: conn.executemany(sql, rows), transaction=True)
+        except Exception as e:
+            logging.error('DB _execute_many %s %s error: %s' % (sql, self.__class__.__name__, str(e)))
+            res = e
+        _finish_span(span, len(rows) if hasattr(rows, '__len__') else None, res)
+        return res
+
+    async def copy_records(self, context_span, db_id, table, records, columns=None, schema_name=None):
+        """
+        Bulk load with binary COPY. Returns COPY status string or exception.
+        """
+        span = _start_span(context_span, "db:%s" % db_id)
+        error = None
+        try:
+            res = await self._run(span, db_id, lambda conn: conn.copy_records_to_table(
+                table,
+                records=records,
+                columns=columns,
+                schema_name=schema_name
+            ))
+        except Exception as e:
+            logging.error('DB _copy_records %s %s error: %s' % (table, self.__class__.__name__, str(e)))
+            res = error = e
+        if span:
+            span.tag('db.table', table)
+        _finish_span(span, len(records) if hasattr(records, '__len__') else None, error)
+        return res
+
+    async def iterate(self, context_span, db_id, sql, *args, prefetch=100):
+        """
+        Server-side cursor over a large result set:
+        async for record in db.iterate(context_span, 'report', sql, arg):
+        """
+        span = _start_span(context_span, "db:%s" % db_id)
+        if span:
+            span.annotate(repr(list(args)))
+        rows = 0
+        try:
+            conn = await self._acquire(span, db_id)
+            try:
+                async with conn.transaction():
+                    async for record in conn.cursor(sql, *args, prefetch=prefetch):
+                        rows += 1
+                        yield record
+            finally:
+                await self.pool.release(conn)
+        except Exception as e:
+            logging.error('DB _iterate %s %s error: %s' % (sql, self.__class__.__name__, str(e)))
+            _finish_span(span, rows, e)
+            span = None
+            raise
+        finally:
+            _finish_span(span, rows)
+
+    async def load_many(self, context_span, db_id, sql, keys, key_column='id'):
+        """
+        Batch lookup for BatchLoader: sql selects rows by key array,
+        e.g. SELECT * FROM t WHERE id = ANY($1). Returns {key: record}.
+        """
+        rows = await self.query_all(context_span, db_id, sql, list(keys))
+        res = {}
+        for row in rows or []:
+            res[row[key_column]] = row
+        return res
+
+    def cache_ttl(self, db_id):
+        if self.cache is None:
+            return 0
+        return self.cache_ttls.get(db_id, self.cache_default_ttl)
+
+    def invalidate(self, db_id, *args):
+        if self.cache is not None:
+            self.cache.invalidate(db_id, *args)
+
+    def invalidate_prefix(self, prefix):
+        if self.cache is not None:
+            self.cache.invalidate_prefix(prefix)
+
+    def transaction(self, context_span):
+        return Transaction(self, context_span)
+
     async def prepare(self):
+        self.query_duration = self.app.metrics.histogram(
+            'db_query_duration_seconds',
+            'Time spent in db calls including pool wait',
+            ('db', 'query')
+        )
+        self.query_errors = self.app.metrics.counter(
+            'db_query_errors_total',
+            'Failed db queries',
+            ('db', 'query')
+        )
         self.app.log_info("Connecting to %s" % self._dsn)
         for i in range(self.connect_max_attempts):
             try:
@@ -105,20 +460,23 @@ class DB(Component):
         raise PrepareError("Could not connect to %s" % self._dsn)
 
     async def start(self):
-        pass
+        if self.stats_interval:
+            self._stats_task = asyncio.ensure_future(self._stats_loop(), loop=self.loop)
 
     async def stop(self):
+        if self._stats_task:
+            self._stats_task.cancel()
+            self._stats_task = None
         self.app.log_info("Disconnecting from %s" % self._dsn)
         await asyncio.sleep(0.3)
 
     async def ping(self):
         async with self.pool.acquire() as conn:
-            async with conn.transaction():
-                try:
-                    await conn.execute('select 1')
-                except Exception as e:
-                    logging.error('DB _execute ping')
-                    res = e
-                else:
-                    res = None
+            try:
+                await conn.execute('select 1')
+            except Exception as e:
+                logging.error('DB _execute ping')
+                res = e
+            else:
+                res = None
         return res
@@ -0,0 +1,120 @@
+import json
+import asyncio
+import logging
+
+import asyncpg
+
+from application.core.component import Component
+from application.core.db import make_dsn
+
+
+class DBListener(Component):
+    """
+    Holds a dedicated connection LISTENing on postgres channels.
+
+    Notifications on 'invalidate_channels' drop cached results of the given
+    DB components. Payload is either a db_id prefix or json
+    {"db_id": "...", "args": [...]} / {"prefix": "..."}.
+    Other channels are dispatched to callbacks added with add_callback().
+    """
+    def __init__(self, config, dbs=None):
+        super(DBListener, self).__init__()
+        listen_config = config.get('listen', {})
+        self._dsn = make_dsn(config)
+        self.dbs = dbs or []
+        self.invalidate_channels = listen_config.get('invalidate_channels', [])
+        self.reconnect_delay = listen_config.get('reconnect_delay', 5)
+        self.check_interval = listen_config.get('check_interval', 10)
+        self.conn = None
+        self._callbacks: dict = {}
+        self._watchdog = None
+
+    def add_callback(self, channel, callback):
+        """
+        :param callback: function or coroutine function (channel, payload)
+        """
+        self._callbacks.setdefault(channel, []).append(callback)
+
+    @property
+    def channels(self):
+        return set(self.invalidate_channels) | set(self._callbacks)
+
+    async def prepare(self):
+        pass
+
+    async def start(self):
+        await self._connect()
+        self._watchdog = asyncio.ensure_future(self._watch(), loop=self.loop)
+
+    async def stop(self):
+        if self._watchdog:
+            self._watchdog.cancel()
+            self._watchdog = None
+        if self.conn is not None:
+            try:
+                await self.conn.close()
+            except Exception as e:
+                logging.error('DB listener close error: %s', e)
+            self.conn = None
+
+    async def _connect(self):
+        conn = None
+        try:
+            conn = await asyncpg.connect(dsn=self._dsn, loop=self.loop)
+            for channel in self.channels:
+                await conn.add_listener(channel, self._on_notification)
+        except Exception as e:
+            self.app.log_err('DB listener could not connect: %s' % e)
+            if conn is not None:
+                # a failed LISTEN must not leak a backend connection on every retry
+                try:
+                    await conn.close()
+                except Exception as close_err:
+                    logging.error('DB listener close error: %s', close_err)
+            return False
+        self.conn = conn
+        self.app.log_info('DB listener subscribed to %s' % ', '.join(sorted(self.channels)))
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.check_interval if self.conn else self.reconnect_delay, loop=self.loop)
+            if self.conn is not None:
+                try:
+                    await self.conn.execute('SELECT 1', timeout=self.check_interval)
+                    continue
+                except Exception as e:
+                    self.app.log_warn('DB listener connection lost: %s' % e)
+                    self.conn.terminate()
+                    self.conn = None
+            if await self._connect():
+                # notifications could be missed while disconnected
+                for db in self.dbs:
+                    if db.cache is not None:
+                        db.cache.clear()
+
+    def _on_notification(self, conn, pid, channel, payload):
+        if channel in self.invalidate_channels:
+            self._invalidate(payload)
+        for callback in self._callbacks.get(channel, []):
+            try:
+                if asyncio.iscoroutinefunction(callback):
+                    asyncio.ensure_future(callback(channel, payload), loop=self.loop)
+                else:
+                    callback(channel, payload)
+            except Exception as e:
+                self.app.log_err(e)
+
+    def _invalidate(self, payload):
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            data = payload
+        for db in self.dbs:
+            if isinstance(data, dict):
+                if 'db_id' in data:
+                    db.invalidate(data['db_id'], *data.get('args', []))
+                else:
+                    db.invalidate_prefix(data.get('prefix', ''))
+            else:
+                db.invalidate_prefix(str(data))
@@ -1,9 +1,8 @@
-import asyncio
 import json
 import logging
 from abc import ABCMeta
 
-import aioamqp
+from application.core.loader import LOADERS_KEY
 
 
 class BaseHandler(object):
@@ -21,6 +20,10 @@ class BaseHandler(object):
     def config(self):
         return self.server.app.config
 
+    @staticmethod
+    def loader(request, name):
+        return request[LOADERS_KEY][name]
+
     def get_response_message(self, code):
         return self.config['errors'][str(code)]
 
@@ -28,20 +31,6 @@ class BaseHandler(object):
         return {'code': code, 'message': self.get_response_message(code)}
 
     async def task(self, context_span, url_out, method, params, pid, non_json=False):
-        # Connecting to rabbitmq
-        time_waited = 0
-        to_wait = 1.5
-        while True:
-            try:
-                transport, protocol = await aioamqp.connect(**self.config['tasks'])
-                break
-            except (OSError, aioamqp.AmqpClosedConnection) as e:
-                to_wait = round(min(30, (to_wait ** 1.5)), 2)
-                logging.info(
-                    "[x] Failed to connect to tasks RabbitMQ: %s. Waiting %s seconds...", e, to_wait)
-                await asyncio.sleep(to_wait)
-                time_waited += to_wait
-        channel = await protocol.channel()
         context_headers = {}
         context_headers.update(context_span.context.make_headers())
         data = {
@@ -57,12 +46,9 @@ class BaseHandler(object):
             'non_json': non_json,
             'context_headers': context_headers
         }
-        await channel.publish(
+        await self.app.tasks_pub.publish(
             json.dumps(data),
             self.config['tasks']['exchange_name'],
             self.config['tasks']['routing_key']
         )
-        await protocol.close()
-        # ensure the socket is closed.
-        transport.close()
         logging.info('[i] Task sended')
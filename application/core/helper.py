@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 from urllib.parse import parse_qs
@@ -6,7 +7,6 @@ import datetime
 
 import decimal
 
-import io
 from aiohttp import BytesPayload
 
 
@@ -200,17 +200,91 @@ def json_encode(data):
     return json.dumps(data, default=json_encoder)
 
 
-def annotate_bytes(span, data):
+def is_sampled(span):
+    """
+    Spans of not sampled traces are noop, nothing should be computed for them.
+    """
+    return span is not None and not span.is_noop
+
+
+def annotate_bytes(span, data, max_bytes=None):
     if isinstance(data, BytesPayload):
-        pl = io.BytesIO()
-        data.write(pl)
-        data = pl.getvalue()
+        # payload keeps the original bytes, no need to copy them through BytesIO
+        data = data._value
+    size = None
+    if max_bytes is not None and isinstance(data, (bytes, bytearray, memoryview, str)) and len(data) > max_bytes:
+        size = len(data)
+        data = data[:max_bytes]
+    if isinstance(data, memoryview):
+        data = data.tobytes()
     try:
-        data_str = data.decode("UTF8")
+        data_str = data.decode("UTF8", errors="replace" if size else "strict")
     except Exception:
         data_str = str(data)
+    if size:
+        data_str += '...[truncated, %s bytes total]' % size
     span.annotate(data_str or 'null')
 
 
+class BodyCapture(object):
+    """
+    Policy for attaching request/response bodies to spans.
+
+    :param max_bytes: bodies are truncated to this size, 0 - no limit
+    :param content_types: allowed content type prefixes, empty - any
+    """
+    DEFAULT_CONTENT_TYPES = (
+        'text/',
+        'application/json',
+        'application/xml',
+        'application/x-www-form-urlencoded',
+    )
+
+    def __init__(self, enabled=True, max_bytes=4096, content_types=DEFAULT_CONTENT_TYPES):
+        self.enabled = enabled
+        self.max_bytes = max_bytes or None
+        self.content_types = tuple(content_types or ())
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        return cls(
+            enabled=config.get('enabled', True),
+            max_bytes=config.get('max_bytes', 4096),
+            content_types=config.get('content_types', cls.DEFAULT_CONTENT_TYPES)
+        )
+
+    def allowed(self, content_type=None):
+        if not self.enabled:
+            return False
+        if not content_type or not self.content_types:
+            return True
+        return content_type.startswith(self.content_types)
+
+    def annotate(self, span, data, content_type=None):
+        if self.allowed(content_type):
+            annotate_bytes(span, data, self.max_bytes)
+
+
+def setup_event_loop(name='asyncio'):
+    """
+    Installs event loop policy ('asyncio' or 'uvloop'), falls back to asyncio
+    when the requested implementation is not available.
+    :return: name of the installed implementation
+    """
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            logging.warning('uvloop is not installed, falling back to asyncio event loop')
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return 'uvloop'
+    elif name != 'asyncio':
+        logging.warning('Unknown event loop %s, falling back to asyncio event loop', name)
+    asyncio.set_event_loop_policy(asyncio.DefaultEventLoopPolicy())
+    return 'asyncio'
+
+
 def raise_graceful_exit():
     raise GracefulExit()
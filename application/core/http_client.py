@@ -1,3 +1,4 @@
+import asyncio
 import os
 import ssl
 import sys
@@ -6,21 +7,132 @@ from urllib.parse import urlparse
 import aiozipkin as az
 import aiozipkin.aiohttp_helpers as azah
 import aiozipkin.constants as azc
-from aiohttp import TCPConnector, ClientSession, client_exceptions
+from aiohttp import TCPConnector, ClientSession, DummyCookieJar, TraceConfig, client_exceptions
 
 from application.core.component import Component
-from application.core.helper import annotate_bytes
+from application.core.helper import is_sampled
+from application.core.singleflight import SingleFlight
+
+COALESCE_METHODS = ('GET', 'HEAD', 'OPTIONS')
 
 
 class HttpClient(Component):
+    def __init__(self, config=None):
+        super(HttpClient, self).__init__()
+        config = config or {}
+        self.config = {
+            'limit': config.get('limit', 100),
+            'limit_per_host': config.get('limit_per_host', 0),
+            'keepalive_timeout': config.get('keepalive_timeout', 30),
+            'use_dns_cache': config.get('use_dns_cache', True),
+            'ttl_dns_cache': config.get('ttl_dns_cache', 10),
+            'coalesce': config.get('coalesce', False),
+            'stats_interval': config.get('stats_interval', 10),
+        }
+        self._flights = SingleFlight()
+        self._sessions: dict = {}
+        self._ssl_contexts: dict = {}
+        self._stats_task = None
+        self.request_duration = None
+        self._trace_config = TraceConfig()
+        self._trace_config.on_request_start.append(self._on_request_start)
+        self._trace_config.on_connection_queued_start.append(self._on_queued_start)
+        self._trace_config.on_connection_queued_end.append(self._on_queued_end)
+
     async def prepare(self):
-        pass
+        self.request_duration = self.app.metrics.histogram(
+            'http_client_request_duration_seconds',
+            'Time spent in outgoing http requests',
+            ('method', 'host', 'status')
+        )
+        # session without client certificate is used by most requests
+        self._get_session(None)
 
     async def start(self):
-        pass
+        if self.config['stats_interval']:
+            self._stats_task = asyncio.ensure_future(self._stats_loop(), loop=self.loop)
 
     async def stop(self):
-        pass
+        if self._stats_task:
+            self._stats_task.cancel()
+            self._stats_task = None
+        sessions = list(self._sessions.values())
+        self._sessions = {}
+        for session in sessions:
+            await session.close()
+
+    def _get_ssl_context(self, cert):
+        sslcontext = self._ssl_contexts.get(cert)
+        if sslcontext is None:
+            pem_file = '%s/cert/%s' % (os.path.realpath(os.path.dirname(sys.argv[0])), cert)
+            sslcontext = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            sslcontext.load_cert_chain(pem_file)
+            self._ssl_contexts[cert] = sslcontext
+        return sslcontext
+
+    def _get_session(self, cert):
+        session = self._sessions.get(cert)
+        if session is None or session.closed:
+            conn = TCPConnector(
+                ssl_context=self._get_ssl_context(cert) if cert else None,
+                limit=self.config['limit'],
+                limit_per_host=self.config['limit_per_host'],
+                keepalive_timeout=self.config['keepalive_timeout'],
+                use_dns_cache=self.config['use_dns_cache'],
+                ttl_dns_cache=self.config['ttl_dns_cache'],
+                loop=self.loop
+            )
+            session = ClientSession(
+                loop=self.loop,
+                read_timeout=self.app.config['system']['time_out'],
+                conn_timeout=self.app.config['system']['time_out'],
+                connector=conn,
+                cookie_jar=DummyCookieJar(loop=self.loop),
+                trace_configs=[self._trace_config]
+            )
+            self._sessions[cert] = session
+        return session
+
+    @staticmethod
+    async def _on_request_start(session, ctx, params):
+        ctx.host = params.url.host
+
+    async def _on_queued_start(self, session, ctx, params):
+        ctx.queued_at = self.loop.time()
+
+    async def _on_queued_end(self, session, ctx, params):
+        # request waited for a free slot because of limit / limit_per_host
+        tags = [('host', ctx.host)]
+        self.app.stats_timer('http_client_pool_wait', (self.loop.time() - ctx.queued_at) * 1000, tags)
+        self.app.stats_counter('http_client_pool_queued', 1, tags)
+
+    def pool_stats(self):
+        """
+        Open connections per host: {host: (in_use, idle)}
+        """
+        res = {}
+        for session in self._sessions.values():
+            connector = session.connector
+            if connector is None or connector.closed:
+                continue
+            for key, acquired in getattr(connector, '_acquired_per_host', {}).items():
+                in_use, idle = res.get(key[0], (0, 0))
+                res[key[0]] = (in_use + len(acquired), idle)
+            for key, conns in getattr(connector, '_conns', {}).items():
+                in_use, idle = res.get(key[0], (0, 0))
+                res[key[0]] = (in_use, idle + len(conns))
+        return res
+
+    async def _stats_loop(self):
+        while True:
+            await asyncio.sleep(self.config['stats_interval'], loop=self.loop)
+            total = 0
+            for host, (in_use, idle) in self.pool_stats().items():
+                tags = [('host', host)]
+                self.app.stats_gauge('http_client_pool_in_use', in_use, tags)
+                self.app.stats_gauge('http_client_pool_idle', idle, tags)
+                total += in_use
+            self.app.stats_gauge('http_client_pool_in_use_total', total)
 
     async def request(
         self,
@@ -33,61 +145,73 @@ class HttpClient(Component):
         cert=None,
         **kwargs
     ):
-        if cert:
-            pem_file = '%s/cert/%s' % (os.path.realpath(os.path.dirname(sys.argv[0])), cert)
-            sslcontext = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            sslcontext.load_cert_chain(pem_file)
-        else:
-            sslcontext = None
-
-        conn = TCPConnector(ssl_context=sslcontext)
+        session = self._get_session(cert)
         headers = headers or {}
-        headers.update(context_span.context.make_headers())
+        key = None
+        if self.config['coalesce'] and method.upper() in COALESCE_METHODS:
+            key = self._coalesce_key(method, url, body, headers, cert, kwargs)
 
         span = None
 
         if context_span:
             span = context_span.tracer.new_child(context_span.context)
             headers.update(span.context.make_headers())
+        traced = is_sampled(span)
+        parsed = urlparse(url)
+        started = self.loop.time()
+        status = 'error'
 
         try:
-            async with ClientSession(
-                    loop=self.loop,
-                    headers=headers,
-                    read_timeout=self.app.config['system']['time_out'],
-                    conn_timeout=self.app.config['system']['time_out'],
-                    connector=conn
-            ) as session:
-                if span:
-                    if 'name' in span_params:
-                        span.name(span_params['name'])
-                    if 'endpoint_name' in span_params:
-                        span.remote_endpoint(span_params['endpoint_name'])
-                    if 'tags' in span_params and span_params['tags']:
-                        for tag_name, tag_val in span_params['tags'].items():
-                            span.tag(tag_name, tag_val)
-                    span.kind(az.CLIENT)
-                    span.tag(azah.HTTP_METHOD, method)
-                    parsed = urlparse(url)
-                    span.tag(azc.HTTP_HOST, parsed.netloc)
-                    span.tag(azc.HTTP_PATH, parsed.path)
-                    if body:
-                        span.tag(azc.HTTP_REQUEST_SIZE, str(len(body)))
-                    span.tag(azc.HTTP_URL, url)
-                    annotate_bytes(span, body)
-                    span.start()
-                resp = await session._request(method, url, data=body, **kwargs)
-                response_body = await resp.read()
-                resp.release()
-                annotate_bytes(span, response_body)
-                if span:
-                    span.tag(azc.HTTP_STATUS_CODE, resp.status)
-                    span.tag(azc.HTTP_RESPONSE_SIZE, str(len(response_body)))
-                    span.finish()
-                a_resp = await self.adapt_resp(span, resp)
-                return a_resp
+            if traced:
+                if 'name' in span_params:
+                    span.name(span_params['name'])
+                if 'endpoint_name' in span_params:
+                    span.remote_endpoint(span_params['endpoint_name'])
+                if 'tags' in span_params and span_params['tags']:
+                    for tag_name, tag_val in span_params['tags'].items():
+                        span.tag(tag_name, tag_val)
+                span.kind(az.CLIENT)
+                span.tag(azah.HTTP_METHOD, method)
+                span.tag(azc.HTTP_HOST, parsed.netloc)
+                span.tag(azc.HTTP_PATH, parsed.path)
+                if body:
+                    span.tag(azc.HTTP_REQUEST_SIZE, str(len(body)))
+                span.tag(azc.HTTP_URL, url)
+                self.app.body_capture.annotate(span, body, (headers.get('Content-Type') or '').split(';')[0])
+                span.start()
+            if key is not None:
+                resp = await self._flights.do(key, self._fetch, session, method, url, body, headers, kwargs)
+            else:
+                resp = await self._fetch(session, method, url, body, headers, kwargs)
+            status = resp.status
+            response_body = await resp.read()
+            if traced:
+                self.app.body_capture.annotate(span, response_body, resp.content_type)
+                span.tag(azc.HTTP_STATUS_CODE, resp.status)
+                span.tag(azc.HTTP_RESPONSE_SIZE, str(len(response_body)))
+                span.finish()
+            a_resp = await self.adapt_resp(span, resp)
+            return a_resp
         except Exception as err:
             raise
+        finally:
+            self.request_duration.labels(method.upper(), parsed.netloc, status).observe(self.loop.time() - started)
+
+    @staticmethod
+    async def _fetch(session, method, url, body, headers, kwargs):
+        resp = await session._request(method, url, data=body, headers=headers, **kwargs)
+        await resp.read()
+        resp.release()
+        return resp
+
+    @staticmethod
+    def _coalesce_key(method, url, body, headers, cert, kwargs):
+        try:
+            key = (method.upper(), url, body, cert, tuple(sorted(headers.items())), tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            return None
+        return key
 
     @staticmethod
     async def adapt_resp(span, resp):
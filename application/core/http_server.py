@@ -1,4 +1,8 @@
 import asyncio
+import csv
+import io
+import threading
+import time
 from functools import partial
 
 import aiohttp_jinja2
@@ -9,14 +13,21 @@ import traceback
 from aiozipkin.constants import HTTP_PATH, HTTP_METHOD
 
 from application.core.handler import BaseHandler
-from application.core.helper import annotate_bytes
+from application.core.helper import json_encode
 from application.core.component import Component
+from application.core.loader import LoaderRegistry, LOADERS_KEY
+from application.core import metrics
+from application.core.profiler import DEFAULT_INTERVAL, MIN_INTERVAL, StackSampler, profile_loop
 import logging
 import aiozipkin as az
 import aiozipkin.aiohttp_helpers as azah
 
 access_logger = logging.getLogger('aiohttp.access')
 SPAN_KEY = 'zipkin_span'
+# skip_trace values: path is not traced at all / traced without bodies
+SKIP_TRACE_ALL = 'all'
+SKIP_TRACE_BODY = 'body'
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 class HttpServer(Component):
@@ -29,8 +40,14 @@ class HttpServer(Component):
             access_log_format=None,
             access_log=access_logger,
             shutdown_timeout=60.0,
-            skip_trace=None
+            skip_trace=None,
+            reuse_port=None,
+            metrics_path=None,
+            profiler=None
     ):
+        """
+        :param profiler: {'enabled': False, 'path': '/admin/profile', 'max_seconds': 60}
+        """
         if not issubclass(handler, BaseHandler):
             raise UserWarning()
         super(HttpServer, self).__init__()
@@ -49,33 +66,88 @@ class HttpServer(Component):
         self.handler = handler(self)
         self._sites: list = []
         self._runner: web_runner.AppRunner = None
-        self.skip_trace = skip_trace or []
+        skip_trace = skip_trace or []
+        if not isinstance(skip_trace, dict):
+            skip_trace = {path: SKIP_TRACE_ALL for path in skip_trace}
+        self.skip_trace = skip_trace
+        self.reuse_port = reuse_port
+        self._loaders: dict = {}
+        self._request_duration = app.metrics.histogram(
+            'http_server_request_duration_seconds',
+            'Time spent handling http requests',
+            ('method', 'route', 'status')
+        )
+        if metrics_path:
+            self.skip_trace.setdefault(metrics_path, SKIP_TRACE_ALL)
+            self.web_app.router.add_get(metrics_path, self._metrics_handler)
+        profiler = profiler or {}
+        self.profiler_max_seconds = profiler.get('max_seconds', 60)
+        self._profiling = False
+        if profiler.get('enabled'):
+            profiler_path = profiler.get('path', '/admin/profile')
+            self.skip_trace.setdefault(profiler_path, SKIP_TRACE_ALL)
+            self.web_app.router.add_get(profiler_path, self._profile_handler)
 
     async def wrap_middleware(self, app, handler):
         async def middleware_handler(request):
+            started = self.loop.time()
+            resp = await traced_handler(request)
+            self._request_duration.labels(
+                request.method, self._route_name(request), resp.status
+            ).observe(self.loop.time() - started)
+            return resp
+
+        async def traced_handler(request):
             if self.app.tracer:
-                if request.path not in self.skip_trace:
+                skip = self.skip_trace.get(request.path)
+                if skip != SKIP_TRACE_ALL:
+                    sampler = self.app.sampler
                     context = az.make_context(request.headers)
                     if context is None:
                         sampled = azah.parse_sampled(request.headers)
                         debug = azah.parse_debug(request.headers)
+                        # tail decision only for traces sampled here, not by the caller
+                        tail = sampled is None and sampler is not None and sampler.tail
+                        if sampled is None and sampler is not None:
+                            sampled = sampler.is_route_sampled(self._route_name(request))
                         span = self.app.tracer.new_trace(sampled=sampled, debug=debug)
+                    elif context.sampled is None and sampler is not None:
+                        # same as join_span, but with the route rate
+                        tail = sampler.tail
+                        sampled = sampler.is_route_sampled(self._route_name(request))
+                        span = self.app.tracer.to_span(context._replace(sampled=sampled))
                     else:
+                        tail = False
                         span = self.app.tracer.join_span(context)
                     request[SPAN_KEY] = span
 
+                    if span.is_noop:
+                        if not tail:
+                            resp, trace_str = await self._handle(span, request, handler)
+                            return resp
+                        started = time.time()
+                        resp, trace_str = await self._handle(span, request, handler)
+                        error = trace_str is not None or resp.status >= 500
+                        if sampler.keep(time.time() - started, error):
+                            self._record_tail(span, request, resp, trace_str, started, error)
+                        return resp
+
                     with span:
                         span_name = '{0} {1}'.format(request.method.upper(), request.path)
                         span.name(span_name)
                         span.kind(azah.SERVER)
                         span.tag(HTTP_PATH, request.path)
                         span.tag(HTTP_METHOD, request.method.upper())
-                        annotate_bytes(span, await request.read())
+                        capture = self.app.body_capture
+                        capture_body = skip != SKIP_TRACE_BODY and capture.enabled
+                        if capture_body and request.can_read_body and capture.allowed(request.content_type):
+                            capture.annotate(span, await request.read())
                         resp, trace_str = await self._handle(span, request, handler)
 
                         if isinstance(resp, web.Response):
                             span.tag(azah.HTTP_STATUS_CODE, resp.status)
-                            annotate_bytes(span, resp.body)
+                            if capture_body:
+                                capture.annotate(span, resp.body, resp.content_type)
                         if trace_str is not None:
                             span.annotate(trace_str)
                         return resp
@@ -88,7 +160,78 @@ class HttpServer(Component):
 
         return middleware_handler
 
+    @staticmethod
+    def _route_name(request):
+        resource = request.match_info.route.resource
+        if resource is None:
+            return ''
+        info = resource.get_info()
+        return info.get('path') or info.get('formatter') or info.get('prefix', '')
+
+    async def _metrics_handler(self, request):
+        return web.Response(
+            body=self.app.metrics.expose().encode(),
+            headers={'Content-Type': metrics.CONTENT_TYPE}
+        )
+
+    async def _profile_handler(self, request):
+        """
+        ?seconds=10&format=collapsed|pstats&interval=0.005&path=/only/this/path
+
+        path and interval apply to the collapsed format, pstats profiles the whole loop thread.
+        """
+        try:
+            seconds = min(float(request.query.get('seconds', 10)), self.profiler_max_seconds)
+            interval = float(request.query.get('interval', DEFAULT_INTERVAL))
+        except ValueError:
+            raise web.HTTPBadRequest(text='seconds and interval must be numbers')
+        if not seconds > 0:
+            raise web.HTTPBadRequest(text='seconds must be positive')
+        if not interval >= MIN_INTERVAL:
+            raise web.HTTPBadRequest(text='interval must be at least %s' % MIN_INTERVAL)
+        fmt = request.query.get('format', 'collapsed')
+        if fmt not in ('collapsed', 'pstats'):
+            raise web.HTTPBadRequest(text='format must be collapsed or pstats')
+        if fmt == 'pstats' and 'path' in request.query:
+            raise web.HTTPBadRequest(text='path filter is supported only with format=collapsed')
+        if self._profiling:
+            raise web.HTTPConflict(text='profiler is already running')
+
+        self._profiling = True
+        try:
+            if fmt == 'pstats':
+                body = await profile_loop(seconds, self.loop)
+                return web.Response(
+                    body=body,
+                    content_type='application/octet-stream',
+                    headers={'Content-Disposition': 'attachment; filename="profile.pstats"'}
+                )
+            sampler = StackSampler(threading.get_ident(), interval, request.query.get('path'))
+            await self.loop.run_in_executor(None, sampler.run, seconds)
+            return web.Response(text=sampler.collapsed())
+        finally:
+            self._profiling = False
+
+    def _record_tail(self, noop_span, request, resp, trace_str, started, error):
+        """
+        Records the server span of a not sampled request after it has finished
+        """
+        span = self.app.tracer.to_span(noop_span.context._replace(sampled=True))
+        span.name('{0} {1}'.format(request.method.upper(), request.path))
+        span.kind(azah.SERVER)
+        span.tag(HTTP_PATH, request.path)
+        span.tag(HTTP_METHOD, request.method.upper())
+        span.tag(azah.HTTP_STATUS_CODE, resp.status)
+        span.tag('sampling.tail', 'error' if error else 'slow')
+        if trace_str is not None:
+            span.tag('error', 'true')
+            span.annotate(trace_str)
+        span.start(ts=started)
+        span.finish()
+
     async def _handle(self, span, request, handler):
+        if self._loaders:
+            request[LOADERS_KEY] = LoaderRegistry(self._loaders, span, self.loop)
         try:
             resp = await handler(request)
             return resp, None
@@ -126,6 +269,14 @@ class HttpServer(Component):
             raise UserWarning('handler must be coroutine function')
         self.web_app.router.add_route(method, uri, partial(self._handle_request, handler))
 
+    def register_loader(self, name, batch_fn, max_batch_size=0):
+        """
+        :param batch_fn: coroutine function (context_span, keys) -> {key: value}
+        """
+        if not asyncio.iscoroutinefunction(batch_fn):
+            raise UserWarning('batch_fn must be coroutine function')
+        self._loaders[name] = (batch_fn, max_batch_size)
+
     def add_static(self, prefix, uri):
         self.web_app.router.add_static(prefix, uri)
 
@@ -134,6 +285,58 @@ class HttpServer(Component):
             raise UserWarning('handler must be coroutine function')
         self.error_handler = handler
 
+    @staticmethod
+    async def stream_rows(request, rows, fmt='ndjson', columns=None, status=200, headers=None):
+        """
+        Writes rows of an async iterable (e.g. DB.iterate) as chunked NDJSON or CSV.
+        """
+        resp = web.StreamResponse(status=status, headers=headers)
+        resp.content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        resp.enable_chunked_encoding()
+        await resp.prepare(request)
+
+        buf = io.StringIO()
+        writer = csv.writer(buf) if fmt == 'csv' else None
+        header_sent = False
+        try:
+            async for row in rows:
+                if writer is not None:
+                    if not header_sent:
+                        if columns is None:
+                            columns = list(row.keys())
+                        writer.writerow(columns)
+                        header_sent = True
+                    writer.writerow([row[col] for col in columns])
+                else:
+                    buf.write(json_encode(dict(row)))
+                    buf.write('\n')
+                if buf.tell() >= STREAM_CHUNK_SIZE:
+                    await resp.write(buf.getvalue().encode())
+                    buf.seek(0)
+                    buf.truncate()
+            if buf.tell():
+                await resp.write(buf.getvalue().encode())
+            await resp.write_eof()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # status and headers are already sent, an error response is not
+            # possible any more, the stream can only be ended early
+            logging.exception('Streaming response for %s failed: %s', request.path, e)
+            span = request.get(SPAN_KEY)
+            if span is not None:
+                span.tag('error', 'true')
+                span.tag('error.message', str(e))
+            try:
+                await resp.write_eof()
+            except Exception:
+                pass
+        finally:
+            # release the connection and cursor held by DB.iterate when the client is gone
+            if hasattr(rows, 'aclose'):
+                await rows.aclose()
+        return resp
+
     async def _handle_request(self, handler, request):
         res = await handler(request.get(SPAN_KEY), request)
         return res
@@ -156,7 +359,8 @@ class HttpServer(Component):
             self.port,
             shutdown_timeout=self.shutdown_timeout,
             ssl_context=None,
-            backlog=128))
+            backlog=128,
+            reuse_port=self.reuse_port))
 
     async def start(self):
         self.app.log_info("Starting http server")
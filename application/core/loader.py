@@ -0,0 +1,78 @@
+import asyncio
+
+LOADERS_KEY = 'batch_loaders'
+
+
+class BatchLoader(object):
+    """
+    Collects load(key) calls made within one event loop tick and resolves
+    them with a single batch_fn(context_span, keys) -> {key: value} call.
+    Loads have to be awaited concurrently (asyncio.gather / load_many) to
+    end up in one batch.
+    """
+    def __init__(self, batch_fn, context_span, loop, max_batch_size=0):
+        self.batch_fn = batch_fn
+        self.context_span = context_span
+        self.loop = loop
+        self.max_batch_size = max_batch_size
+        self._queue: list = []
+        self._futures: dict = {}
+
+    def load(self, key):
+        fut = self._futures.get(key)
+        if fut is not None:
+            return fut
+        fut = self.loop.create_future()
+        self._futures[key] = fut
+        self._queue.append((key, fut))
+        if len(self._queue) == 1:
+            self.loop.call_soon(self._dispatch)
+        return fut
+
+    async def load_many(self, keys):
+        return await asyncio.gather(*[self.load(key) for key in keys], loop=self.loop)
+
+    def clear(self, key=None):
+        if key is None:
+            self._futures = {}
+        else:
+            self._futures.pop(key, None)
+
+    def _dispatch(self):
+        queue, self._queue = self._queue, []
+        size = self.max_batch_size or len(queue)
+        for i in range(0, len(queue), size):
+            asyncio.ensure_future(self._run(queue[i:i + size]), loop=self.loop)
+
+    async def _run(self, queue):
+        try:
+            res = await self.batch_fn(self.context_span, [key for key, _ in queue])
+        except Exception as e:
+            for key, fut in queue:
+                self._futures.pop(key, None)
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        res = res or {}
+        for key, fut in queue:
+            if not fut.done():
+                fut.set_result(res.get(key))
+
+
+class LoaderRegistry(object):
+    """
+    Request scoped loaders, created on first access by name.
+    """
+    def __init__(self, batch_fns, context_span, loop):
+        self._batch_fns = batch_fns
+        self._loaders: dict = {}
+        self.context_span = context_span
+        self.loop = loop
+
+    def __getitem__(self, name):
+        loader = self._loaders.get(name)
+        if loader is None:
+            batch_fn, max_batch_size = self._batch_fns[name]
+            loader = BatchLoader(batch_fn, self.context_span, self.loop, max_batch_size)
+            self._loaders[name] = loader
+        return loader
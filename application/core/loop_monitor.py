@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from application.core.component import Component
+
+LAG_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0)
+
+
+class LoopMonitor(Component):
+    """
+    Measures event loop scheduling lag with a periodic tick.
+
+    A watchdog thread checks that the tick keeps running. When the loop is
+    blocked longer than slow_callback seconds it logs the stack of the loop
+    thread and counts the blocking code location.
+    """
+    def __init__(self, config=None):
+        super(LoopMonitor, self).__init__()
+        config = config or {}
+        self.interval = config.get('interval', 0.1)
+        self.slow_callback = config.get('slow_callback', 0.1)
+        self.stack_limit = config.get('stack_limit', 20)
+        self.lag = None
+        self.slow_callbacks = None
+        self._task = None
+        self._watchdog: threading.Thread = None
+        self._stopped = threading.Event()
+        self._loop_thread = None
+        self._deadline = 0
+        self._reported = 0
+
+    async def prepare(self):
+        self.lag = self.app.metrics.histogram(
+            'loop_lag_seconds',
+            'Delay of event loop ticks',
+            buckets=LAG_BUCKETS
+        )
+        self.slow_callbacks = self.app.metrics.counter(
+            'loop_slow_callbacks_total',
+            'Event loop blocks longer than the slow callback threshold',
+            ('location',)
+        )
+
+    async def start(self):
+        self._loop_thread = threading.get_ident()
+        self._deadline = time.monotonic() + self.interval
+        self._task = asyncio.ensure_future(self._tick(), loop=self.loop)
+        if self.slow_callback:
+            self._stopped.clear()
+            self._watchdog = threading.Thread(target=self._watch, name='loop-monitor', daemon=True)
+            self._watchdog.start()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._watchdog:
+            self._stopped.set()
+            self._watchdog.join()
+            self._watchdog = None
+
+    async def _tick(self):
+        while True:
+            expected = self.loop.time() + self.interval
+            self._deadline = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval, loop=self.loop)
+            lag = max(0.0, self.loop.time() - expected)
+            self.lag.observe(lag)
+            self.app.stats_timer('loop_lag', lag * 1000)
+
+    def _watch(self):
+        check_interval = self.slow_callback / 2
+        while not self._stopped.wait(check_interval):
+            deadline = self._deadline
+            blocked = time.monotonic() - deadline
+            if blocked < self.slow_callback or deadline == self._reported:
+                continue
+            # report every block once
+            self._reported = deadline
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = traceback.format_stack(frame, self.stack_limit)
+            code = frame.f_code
+            location = '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+            logging.warning(
+                'Event loop blocked for more than %.3fs at %s\n%s', blocked, location, ''.join(stack))
+            self.loop.call_soon_threadsafe(self._on_slow_callback, location)
+
+    def _on_slow_callback(self, location):
+        self.slow_callbacks.labels(location).inc()
+        self.app.stats_counter('loop_slow_callbacks', 1, [('location', location)])
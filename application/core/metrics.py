@@ -0,0 +1,180 @@
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class CounterValue(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+
+class GaugeValue(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, value=1):
+        self.value += value
+
+    def dec(self, value=1):
+        self.value -= value
+
+
+class HistogramValue(object):
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # last slot is the +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric(object):
+    """
+    Metric family, values are kept per label values tuple.
+    Hot path callers can keep the object returned by labels() to skip the lookup.
+    """
+    TYPE = None
+    VALUE_CLASS = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: dict = {}
+
+    def labels(self, *values):
+        # label values are strings in the exposition, 200 and '200' are one series
+        values = tuple(map(str, values))
+        child = self._values.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s expects labels %s' % (self.name, self.labelnames))
+            child = self._values[values] = self._new_value()
+        return child
+
+    def _new_value(self):
+        return self.VALUE_CLASS()
+
+    def expose(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.TYPE),
+        ]
+        for values, child in sorted(self._values.items()):
+            lines.extend(self._samples(values, child))
+        return lines
+
+    def _samples(self, values, child):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, values), _format_value(child.value))]
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+    VALUE_CLASS = CounterValue
+
+    def inc(self, value=1):
+        self.labels().inc(value)
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+    VALUE_CLASS = GaugeValue
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, 'le="%s"' % _format_value(bound))
+            lines.append('%s_bucket%s %s' % (self.name, labels, cumulative))
+        labels = _format_labels(self.labelnames, values)
+        lines.append('%s_sum%s %s' % (self.name, labels, _format_value(child.sum)))
+        lines.append('%s_count%s %s' % (self.name, labels, child.count))
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    In-process metrics in prometheus text format. Metrics are created once
+    (get or create by name) and updated without locks, the app is single threaded.
+    """
+    def __init__(self):
+        self._metrics: dict = {}
+
+    def _get(self, cls, name, help_text, labelnames, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, help_text, labelnames, **kwargs)
+        elif not isinstance(metric, cls):
+            raise UserWarning('Metric %s is already registered as %s' % (name, metric.TYPE))
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._get(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._get(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def expose(self):
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].expose())
+        lines.append('')
+        return '\n'.join(lines)
@@ -0,0 +1,77 @@
+import asyncio
+import cProfile
+import marshal
+import os
+import sys
+import time
+
+DEFAULT_INTERVAL = 0.005
+MIN_INTERVAL = 0.001
+# HttpServer middleware function, its 'request' local attributes samples to a request
+REQUEST_FRAME_NAME = 'middleware_handler'
+
+
+class StackSampler(object):
+    """
+    Samples the stack of one thread (the event loop) from a background
+    thread and counts identical stacks in collapsed format
+    ("outer;...;inner count", as used by flamegraph tools).
+
+    Stacks running inside a request are prefixed with "METHOD path",
+    with path set only samples of requests to that path are kept.
+    """
+    def __init__(self, thread_id, interval=DEFAULT_INTERVAL, path=None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.path = path
+        self.samples = 0
+        self.stacks: dict = {}
+
+    def run(self, seconds):
+        """
+        Blocking, has to be called from another thread
+        """
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self._sample(frame)
+            del frame
+            time.sleep(self.interval)
+        return self
+
+    def _sample(self, frame):
+        stack = []
+        request = None
+        while frame is not None:
+            code = frame.f_code
+            if request is None and code.co_name == REQUEST_FRAME_NAME:
+                request = frame.f_locals.get('request')
+            stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        if self.path is not None and getattr(request, 'path', None) != self.path:
+            return
+        if request is not None:
+            stack.append('%s %s' % (request.method, request.path))
+        key = ';'.join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def collapsed(self):
+        items = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)
+        return ''.join('%s %s\n' % item for item in items)
+
+
+async def profile_loop(seconds, loop):
+    """
+    Runs cProfile on the event loop thread for seconds,
+    returns stats in the pstats file format (marshal).
+    """
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        await asyncio.sleep(seconds, loop=loop)
+    finally:
+        profile.disable()
+    profile.create_stats()
+    return marshal.dumps(profile.stats)
@@ -0,0 +1,94 @@
+import time
+
+import aiozipkin as az
+
+
+class AdaptiveSampler(az.Sampler):
+    """
+    Head sampling with per route rates and a cap of new traces per second.
+
+    Requests which were not sampled at the start can still be kept by the
+    tail decision (keep()) when they failed or were slower than
+    slow_threshold seconds, the http server then records them afterwards.
+    """
+    def __init__(
+            self,
+            sample_rate=1.0,
+            max_per_second=0,
+            routes=None,
+            slow_threshold=0,
+            keep_errors=True,
+            tail_max_per_second=0
+    ):
+        super(AdaptiveSampler, self).__init__(sample_rate=sample_rate)
+        self.max_per_second = max_per_second
+        self.routes = routes or {}
+        self.slow_threshold = slow_threshold
+        self.keep_errors = keep_errors
+        self._head_limit = RateLimit(max_per_second)
+        self._tail_limit = RateLimit(tail_max_per_second)
+
+    @classmethod
+    def from_config(cls, config, sample_rate=1.0):
+        """
+        :param config: {'sample_rate': 0.1, 'max_per_second': 10, 'routes': {'/path/{id}': 1.0},
+            'slow_threshold': 1.0, 'keep_errors': True, 'tail_max_per_second': 0}
+        """
+        config = config or {}
+        return cls(
+            sample_rate=config.get('sample_rate', sample_rate),
+            max_per_second=config.get('max_per_second', 0),
+            routes=config.get('routes'),
+            slow_threshold=config.get('slow_threshold', 0),
+            keep_errors=config.get('keep_errors', True),
+            tail_max_per_second=config.get('tail_max_per_second', 0)
+        )
+
+    @property
+    def tail(self):
+        return bool(self.keep_errors or self.slow_threshold)
+
+    def is_sampled(self, trace_id):
+        return self._sample(self._sample_rate)
+
+    def is_route_sampled(self, route):
+        """
+        :param route: path pattern of the matched resource, e.g. /users/{id}
+        """
+        return self._sample(self.routes.get(route, self._sample_rate))
+
+    def keep(self, duration, error):
+        """
+        Tail decision for a request which was not sampled
+        :param duration: seconds
+        """
+        if (error and self.keep_errors) or (self.slow_threshold and duration >= self.slow_threshold):
+            return self._tail_limit.acquire()
+        return False
+
+    def _sample(self, rate):
+        if rate <= 0.0 or (rate < 1.0 and self._rng.random() > rate):
+            return False
+        return self._head_limit.acquire()
+
+
+class RateLimit(object):
+    """
+    Allows at most limit events per second, 0 means no limit
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self._second = 0
+        self._count = 0
+
+    def acquire(self):
+        if not self.limit:
+            return True
+        second = int(time.monotonic())
+        if second != self._second:
+            self._second = second
+            self._count = 0
+        if self._count >= self.limit:
+            return False
+        self._count += 1
+        return True
@@ -0,0 +1,26 @@
+import asyncio
+
+
+class SingleFlight(object):
+    """
+    Identical concurrent calls (same key) share one in-flight awaitable.
+    """
+    def __init__(self, loop=None):
+        self.loop = loop
+        self._calls: dict = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, func, *args):
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(func(*args), loop=self.loop)
+            self._calls[key] = fut
+            fut.add_done_callback(lambda f: self._forget(key, f))
+        # one caller being cancelled must not cancel the shared call
+        return await asyncio.shield(fut, loop=self.loop)
+
+    def _forget(self, key, fut):
+        if self._calls.get(key) is fut:
+            del self._calls[key]
@@ -1,5 +1,8 @@
 import re
+import random
 import asyncio
+from collections import deque
+
 import aiozipkin.transport as azt
 import aiozipkin.constants as azc
 from aiostatsd.client import StatsdClient
@@ -7,6 +10,71 @@ import logging
 
 STATS_CLEAN_NAME_RE = re.compile('[^0-9a-zA-Z_.-]')
 STATS_CLEAN_TAG_RE = re.compile('[^0-9a-zA-Z_=.-]')
+STATS_KIND_SPANS = ('db', 'db_acquire', 'db_query', 'redis')
+# ethernet MTU minus IP and UDP headers
+STATS_PACKET_SIZE = 1432
+STATS_NAME_CACHE_SIZE = 10000
+STATS_PERCENTILES = (50, 95, 99)
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+
+
+class StatsAggregator(object):
+    """
+    Collects timers and counters between flushes.
+
+    Every timer name keeps at most max_samples values (reservoir sampling),
+    on flush they are sent with the matching sample rate so statsd still
+    counts all of them. With summary=True only <name>.count, .sum, .max and
+    percentile gauges are sent for each timer.
+    """
+    def __init__(self, max_samples=100, summary=False):
+        self.max_samples = max_samples
+        self.summary = summary
+        self._timers: dict = {}
+        self._counters: dict = {}
+
+    def timer(self, key, value):
+        item = self._timers.get(key)
+        if item is None:
+            self._timers[key] = [1, value, value, [value]]
+            return
+        item[0] += 1
+        item[1] += value
+        if value > item[2]:
+            item[2] = value
+        samples = item[3]
+        if len(samples) < self.max_samples:
+            samples.append(value)
+        else:
+            i = random.randrange(item[0])
+            if i < self.max_samples:
+                samples[i] = value
+
+    def counter(self, key, value):
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def flush(self, client):
+        """
+        :param client: aiostatsd low level client, it packs metrics into packets
+        """
+        timers, self._timers = self._timers, {}
+        counters, self._counters = self._counters, {}
+        for (name, suffix), value in counters.items():
+            client.send_counter(name + suffix, value, 1.0)
+        for (name, suffix), (count, total, max_value, samples) in timers.items():
+            if self.summary:
+                samples.sort()
+                client.send_counter(name + '.count' + suffix, count, 1.0)
+                client.send_gauge(name + '.sum' + suffix, total, 1.0)
+                client.send_gauge(name + '.max' + suffix, max_value, 1.0)
+                for p in STATS_PERCENTILES:
+                    value = samples[min(len(samples) - 1, len(samples) * p // 100)]
+                    client.send_gauge('%s.p%s%s' % (name, p, suffix), value, 1.0)
+            else:
+                rate = len(samples) / count
+                for value in samples:
+                    client.send_timer(name + suffix, value, rate)
 
 
 class TracerTransport(azt.Transport):
@@ -17,8 +85,13 @@ class TracerTransport(azt.Transport):
             statsd_addr,
             statsd_prefix,
             send_inteval,
-            loop
+            loop,
+            statsd_aggregate=None,
+            span_queue=None
     ):
+        """
+        :param span_queue: {'max_size': 10000, 'batch_size': 1000, 'drop': 'oldest' | 'newest', 'timeout': 5}
+        """
         tracer_url = tracer_url or 'http://localhost:9411/'
         super(TracerTransport, self).__init__(tracer_url, send_inteval=send_inteval, loop=loop)
         self.loop = loop
@@ -26,39 +99,93 @@ class TracerTransport(azt.Transport):
         self.__statsd_addr = statsd_addr
         self.__statsd_prefix = statsd_prefix
 
+        span_queue = span_queue or {}
+        self.max_size = span_queue.get('max_size', 10000)
+        self.batch_size = span_queue.get('batch_size', 1000)
+        self.drop_policy = span_queue.get('drop', DROP_OLDEST)
+        if self.drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise UserWarning('Unknown span drop policy %s' % self.drop_policy)
+        self.send_timeout = span_queue.get('timeout', 5)
+        # finished records for zipkin, serialized only when sent
+        self._queue = deque(maxlen=self.max_size)
+        self._dropped = 0
+        # every finished record goes to statsd, drained on each flush
+        self._stats_records: list = []
+
+        self._names: dict = {}
+
         self.stats = None
+        self.aggregator = None
         if self.__statsd_addr:
+            statsd_aggregate = statsd_aggregate or {}
             addr = self.__statsd_addr.split(':')
             host = addr[0]
             port = int(addr[1]) if len(addr) > 1 else 8125
-            self.stats = StatsdClient(host, port)
+            self.stats = StatsdClient(host, port, packet_size=statsd_aggregate.get('packet_size', STATS_PACKET_SIZE))
+            self.aggregator = StatsAggregator(
+                max_samples=statsd_aggregate.get('max_samples', 100),
+                summary=statsd_aggregate.get('summary', False)
+            )
             asyncio.ensure_future(self.stats.run(), loop=loop)
 
     async def close(self):
+        await super(TracerTransport, self).close()
         if self.stats:
             try:
                 await asyncio.sleep(.001, loop=self.loop)
                 await self.stats.stop()
             except Exception as e:
                 logging.exception(e)
-        await super(TracerTransport, self).close()
+
+    async def _sender_loop(self):
+        # runs on every interval, aggregated metrics are flushed without spans too
+        while not self._ender.done():
+            await self._send()
+            await self._wait()
+
+    def send(self, record):
+        if self.stats:
+            self._stats_records.append(record)
+        if self.__tracer != 'zipkin':
+            return
+        if len(self._queue) >= self.max_size:
+            self._dropped += 1
+            if self.drop_policy == DROP_NEWEST:
+                return
+        self._queue.append(record)
 
     async def _send(self):
-        data = self._queue[:]
+        dropped, self._dropped = self._dropped, 0
+        if dropped:
+            self.send_counter('tracer_dropped_spans', dropped, [('policy', self.drop_policy)])
 
-        try:
-            if self.__statsd_addr:
-                await self._send_to_statsd(data)
-        except Exception as e:
-            logging.exception(e)
+        if self.stats:
+            records, self._stats_records = self._stats_records, []
+            try:
+                await self._send_to_statsd([record.asdict() for record in records])
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                self.aggregator.flush(self.stats.client)
 
+        # one zipkin batch per flush, spans over batch_size per interval wait in
+        # the bounded queue, so a slow zipkin can not hold the flush
+        batch = [self._queue.popleft().asdict() for _ in range(min(self.batch_size, len(self._queue)))]
+        if batch:
+            await self._post(batch)
+
+    async def _post(self, data):
         try:
-            if self.__tracer == 'zipkin':
-                await super(TracerTransport, self)._send()
-            else:
-                self._queue = []
+            headers = {'Content-Type': 'application/json'}
+            async with self._session.post(
+                    self._address, json=data, headers=headers, timeout=self.send_timeout) as resp:
+                body = await resp.text()
+                if resp.status >= 300:
+                    raise RuntimeError('zipkin responded with code: %s and body: %s' % (resp.status, body))
         except Exception as e:
-            logging.exception(e)
+            # spans are not retried, the queue would only grow while zipkin is down
+            self.send_counter('tracer_failed_spans', len(data))
+            logging.error('Can not send spans to zipkin: %s', e)
 
     async def _send_to_statsd(self, data):
         if self.stats:
@@ -85,24 +212,53 @@ class TracerTransport(azt.Transport):
                         if tag_key in t:
                             tags.append((tag_name, t[tag_key]))
 
-                elif rec['name'].startswith('db:'):
-                    name = 'db'
-                    tags.append(('kind', rec['name'][len('db:'):]))
-                elif rec['name'].startswith('redis:'):
-                    name = 'redis'
-                    tags.append(('kind', rec['name'][len('redis:'):]))
+                elif rec['name'].split(':', 1)[0] in STATS_KIND_SPANS and ':' in rec['name']:
+                    name, kind = rec['name'].split(':', 1)
+                    tags.append(('kind', kind))
                 elif rec['name'] == 'sleep':
                     name = 'sleep'
                 else:
                     name = rec['name']
 
-                name = self.__statsd_prefix + name
-                name = name.replace(' ', '_')
-                name = STATS_CLEAN_NAME_RE.sub('', name)
+                self.aggregator.timer(self._stats_key(name, tags), int(round(rec["duration"] / 1000)))
+
+    def _stats_key(self, name, tags=None):
+        """
+        Cleaned (name, tags suffix) pair, cached by raw name and tags
+        """
+        raw = (name, tuple(tags)) if tags else name
+        key = self._names.get(raw)
+        if key is not None:
+            return key
+
+        clean_name = self.__statsd_prefix + name
+        clean_name = clean_name.replace(' ', '_')
+        clean_name = STATS_CLEAN_NAME_RE.sub('', clean_name)
 
-                if len(tags) > 0:
-                    for tag in tags:
-                        t = tag[1].replace(':', '-')
-                        t = STATS_CLEAN_TAG_RE.sub('', t)
-                        name += ',' + tag[0] + "=" + t
-                self.stats.send_timer(name, int(round(rec["duration"] / 1000)), rate=1.0)
+        suffix = ''
+        if tags:
+            for tag in tags:
+                t = str(tag[1]).replace(':', '-')
+                t = STATS_CLEAN_TAG_RE.sub('', t)
+                suffix += ',' + tag[0] + "=" + t
+
+        if len(self._names) >= STATS_NAME_CACHE_SIZE:
+            self._names.clear()
+        key = self._names[raw] = (clean_name, suffix)
+        return key
+
+    def _stats_name(self, name, tags=None):
+        clean_name, suffix = self._stats_key(name, tags)
+        return clean_name + suffix
+
+    def send_gauge(self, name, value, tags=None):
+        if self.stats:
+            self.stats.send_gauge(self._stats_name(name, tags), value)
+
+    def send_counter(self, name, value=1, tags=None):
+        if self.stats:
+            self.aggregator.counter(self._stats_key(name, tags), value)
+
+    def send_timer(self, name, value, tags=None):
+        if self.stats:
+            self.aggregator.timer(self._stats_key(name, tags), int(round(value)))
@@ -2,15 +2,31 @@ from application.core.db import DB
 
 
 class MainDb(DB):
+    QUERIES = {
+        'get_sample_data': """
+            SELECT
+                *
+            FROM
+                main.sample
+        """,
+    }
+
     def __init__(self, config):
         super().__init__(config)
 
     async def get_sample_data(self, context_span, msisdn):
+        res = await self.named_query_all(context_span, 'get_sample_data')
+        return res
+
+    async def load_samples(self, context_span, msisdns):
         sql = """
             SELECT
                 *
             FROM
                 main.sample
+            WHERE
+                msisdn = ANY($1)
         """
-        res = await self.query_all(context_span, 'get_sample_data', sql, int(msisdn))
+        rows = await self.load_many(context_span, 'load_samples', sql, [int(m) for m in msisdns], 'msisdn')
+        res = {m: rows.get(int(m)) for m in msisdns}
         return res
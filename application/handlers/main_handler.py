@@ -17,6 +17,7 @@ class MainHandler(BaseHandler):
         main_parser = MainParser(self)
 
         self.server.add_route('GET', '/', main_parser.index_parser)
+        self.server.register_loader('samples', self.app.db_main.load_samples)
         self.server.add_static('/static', os.path.realpath(os.path.dirname(sys.argv[0])) + '/static/')
 
         self.server.set_error_handler(self.error_handler)
@@ -0,0 +1,148 @@
+"""
+Compares event loop implementations on the HttpServer request path.
+
+    python bench/loop_bench.py --loops asyncio uvloop --duration 10 --concurrency 64
+
+Every loop gets its own forked server process, the load generator always
+runs on the default asyncio loop so only the server side differs.
+"""
+import argparse
+import asyncio
+import importlib.util
+import os
+import signal
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from aiohttp import ClientSession, TCPConnector, web  # noqa: E402
+
+from application.core.app import BaseApp  # noqa: E402
+from application.core.handler import BaseHandler  # noqa: E402
+from application.core.helper import setup_event_loop  # noqa: E402
+from application.core.http_server import HttpServer  # noqa: E402
+
+
+class BenchHandler(BaseHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server.add_route('GET', '/bench', self.bench)
+
+    @staticmethod
+    async def bench(context_span, request):
+        return web.json_response({'code': 0, 'message': 'ok'})
+
+
+class BenchApp(BaseApp):
+    def __init__(self, config, loop):
+        super().__init__(config=config, loop=loop)
+        self.attach_component(
+            'http_srv',
+            HttpServer(self, config['system']['host'], config['system']['port'], BenchHandler)
+        )
+        if config['bench_trace']:
+            self.setup_logging(
+                tracer_driver='bench',
+                tracer_svc_name='bench',
+                tracer_url=None,
+                statsd_addr=None,
+                statsd_prefix=''
+            )
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(loop_name, port, trace):
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            setup_event_loop(loop_name)
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            config = {'system': {'host': '127.0.0.1', 'port': port}, 'bench_trace': trace}
+            code = BenchApp(config=config, loop=loop).run()
+        finally:
+            os._exit(code)
+    return pid
+
+
+async def wait_ready(url, timeout=10):
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as resp:
+                    await resp.read()
+                    return True
+            except OSError:
+                await asyncio.sleep(0.1)
+    return False
+
+
+async def load(url, duration, concurrency):
+    latencies = []
+    stop_at = time.monotonic() + duration
+
+    async def worker(session):
+        while time.monotonic() < stop_at:
+            started = time.monotonic()
+            async with session.get(url) as resp:
+                await resp.read()
+            latencies.append(time.monotonic() - started)
+
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+    return latencies
+
+
+def run_one(loop_name, args):
+    if loop_name != 'asyncio' and importlib.util.find_spec(loop_name) is None:
+        return None
+    port = free_port()
+    url = 'http://127.0.0.1:%s/bench' % port
+    pid = start_server(loop_name, port, args.trace)
+    client_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(client_loop)
+    try:
+        if not client_loop.run_until_complete(wait_ready(url)):
+            return None
+        latencies = client_loop.run_until_complete(load(url, args.duration, args.concurrency))
+    finally:
+        client_loop.close()
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    latencies.sort()
+    count = len(latencies)
+    return {
+        'rps': count / args.duration,
+        'p50': latencies[count // 2] * 1000,
+        'p99': latencies[min(count - 1, int(count * 0.99))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loops', nargs='+', default=['asyncio', 'uvloop'])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--trace', action='store_true', help='enable tracer on the server')
+    args = parser.parse_args()
+
+    print('%-10s %12s %10s %10s' % ('loop', 'req/s', 'p50 ms', 'p99 ms'))
+    for loop_name in args.loops:
+        res = run_one(loop_name, args)
+        if res is None:
+            print('%-10s %12s' % (loop_name, 'n/a'))
+            continue
+        print('%-10s %12.1f %10.2f %10.2f' % (loop_name, res['rps'], res['p50'], res['p99']))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@ import logging
 import asyncio
 
 from application.app import Application
+from application.core.helper import setup_event_loop
 
 LOG_FORMAT = '%(levelname) -10s %(asctime)s %(name) -30s %(funcName) -35s %(lineno) -5d: %(message)s'
 
@@ -24,6 +25,7 @@ def main():
     log = logging.getLogger()
     log.addHandler(ch)
 
+    setup_event_loop(config['system'].get('event_loop', 'asyncio'))
     loop = asyncio.get_event_loop()
     app = Application(config=config, loop=loop)
     app.run()
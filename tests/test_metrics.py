@@ -0,0 +1,50 @@
+from application.core.metrics import MetricsRegistry
+
+
+def test_expose_counter_and_gauge():
+    registry = MetricsRegistry()
+    registry.counter('requests_total', 'Requests').inc(2)
+    registry.gauge('in_use', 'In use', ('pool',)).labels('main').set(3)
+
+    lines = registry.expose().splitlines()
+
+    assert '# TYPE requests_total counter' in lines
+    assert 'requests_total 2' in lines
+    assert '# TYPE in_use gauge' in lines
+    assert 'in_use{pool="main"} 3' in lines
+
+
+def test_expose_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('duration_seconds', 'Duration', ('method',), buckets=(0.1, 1))
+    histogram.labels('GET').observe(0.1)
+    histogram.labels('GET').observe(0.5)
+    histogram.labels('GET').observe(5)
+
+    lines = registry.expose().splitlines()
+
+    assert 'duration_seconds_bucket{method="GET",le="0.1"} 1' in lines
+    assert 'duration_seconds_bucket{method="GET",le="1"} 2' in lines
+    assert 'duration_seconds_bucket{method="GET",le="+Inf"} 3' in lines
+    assert 'duration_seconds_sum{method="GET"} 5.6' in lines
+    assert 'duration_seconds_count{method="GET"} 3' in lines
+
+
+def test_expose_mixed_label_value_types():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('client_seconds', 'Client', ('host', 'status'))
+    histogram.labels('example.com', 200).observe(0.01)
+    histogram.labels('example.com', 'error').observe(0.01)
+    histogram.labels('example.com', '200').observe(0.01)
+
+    lines = registry.expose().splitlines()
+
+    assert 'client_seconds_count{host="example.com",status="200"} 2' in lines
+    assert 'client_seconds_count{host="example.com",status="error"} 1' in lines
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.counter('errors_total', 'Errors', ('message',)).labels('say "hi"\n').inc()
+
+    assert 'errors_total{message="say \\"hi\\"\\n"} 1' in registry.expose().splitlines()